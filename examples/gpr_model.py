@@ -41,8 +41,12 @@ class ExactGPModel(gpytorch.models.ExactGP):
 
 #%%
 
-def train(model: ExactGPModel, train_x, train_y, training_iter=900, lr_scheduler_step=300, lr=1):
+def train(model: ExactGPModel, train_x, train_y, training_iter=900, lr_scheduler_step=300, lr=1,
+          max_cholesky_size=4096, compile_kernel=False):
     training_iter = training_iter
+    if compile_kernel:
+        # the kernel is plain tensor code evaluated on the fixed training set, let Inductor fuse it
+        model.covar_module.compile(dynamic=False)
     # Find optimal model hyperparameters
     model.train()
     model.likelihood.train()
@@ -53,34 +57,39 @@ def train(model: ExactGPModel, train_x, train_y, training_iter=900, lr_scheduler
     # "Loss" for GPs - the marginal log likelihood
     mll = gpytorch.mlls.ExactMarginalLogLikelihood(model.likelihood, model)
 
-    for i in range(training_iter):
-        # Zero gradients from previous iteration
-        #print(scheduler.get_lr())
-        optimizer.zero_grad()
-        # Output from model
-        output = model(train_x)
-        # Calc loss and backprop gradients
-        loss = -mll(output, train_y)
-        loss.backward(retain_graph=True)
-        optimizer.step()
-        scheduler.step()
-        if i % 100 == 99:
-            try:
-                #lengthscale = model.covar_module.lengthscale.item()
-                lengthscale = model.covar_module.base_kernel.lengthscale.item()
-                #variance = model.variance.item()
-                variance = model.covar_module.outputscale.item()
-            except:
-                lengthscale = model.covar_module.measure.lengthscale.item()
-                # variance = (model.variance * model.covar_module.measure.variance).item()
-                variance = model.covar_module.measure.variance.item()
-            # mean = model.mean.item()
-            mean = model.mean_module.constant.item()
-            #mean = 0
-            print('Iter %d/%d - Loss: %.3f   lengthscale: %.3f variance: %.3f   noise: %.3f, mean: %3f' % (
-                i + 1, training_iter, loss.item(),
-                lengthscale,
-                variance,
-                model.likelihood.noise.item(),
-                mean
-            ))
\ No newline at end of file
+    # the training set is fixed, so pick the solver once: exact Cholesky for small sets, CG/Lanczos otherwise
+    exact = train_x.shape[0] <= max_cholesky_size
+    with gpytorch.settings.max_cholesky_size(max_cholesky_size), \
+            gpytorch.settings.fast_computations(covar_root_decomposition=not exact, log_prob=not exact,
+                                                solves=not exact):
+        for i in range(training_iter):
+            # Zero gradients from previous iteration
+            #print(scheduler.get_lr())
+            optimizer.zero_grad()
+            # Output from model
+            output = model(train_x)
+            # Calc loss and backprop gradients
+            loss = -mll(output, train_y)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            if i % 100 == 99:
+                try:
+                    #lengthscale = model.covar_module.lengthscale.item()
+                    lengthscale = model.covar_module.base_kernel.lengthscale.item()
+                    #variance = model.variance.item()
+                    variance = model.covar_module.outputscale.item()
+                except:
+                    lengthscale = model.covar_module.measure.lengthscale.item()
+                    # variance = (model.variance * model.covar_module.measure.variance).item()
+                    variance = model.covar_module.measure.variance.item()
+                # mean = model.mean.item()
+                mean = model.mean_module.constant.item()
+                #mean = 0
+                print('Iter %d/%d - Loss: %.3f   lengthscale: %.3f variance: %.3f   noise: %.3f, mean: %3f' % (
+                    i + 1, training_iter, loss.item(),
+                    lengthscale,
+                    variance,
+                    model.likelihood.noise.item(),
+                    mean
+                ))
\ No newline at end of file
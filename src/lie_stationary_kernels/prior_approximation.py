@@ -68,19 +68,19 @@ class RandomPhaseApproximation(torch.nn.Module):
         self.phases = self.sample_phases()
 
     def make_embedding(self, x):
-        embeddings = []
         phases = self.phases  # [num_phase, ...]
         # left multiplication
         phase_x_inv = self.kernel.manifold.pairwise_embed(phases, x)  # [len(x), num_phase, ...]
 
-        for i, eigenspace in enumerate(islice(self.kernel.manifold.lb_eigenspaces, self.approx_order)):
-            lmd = eigenspace.lb_eigenvalue
-            f = eigenspace.phase_function
-            eigen_embedding = f(phase_x_inv).real.view(self.phase_order, x.size()[0]).T
-            eigen_embedding = torch.sqrt(torch.abs(self.kernel.measure.variance[0]) * self.kernel.measure(lmd)) * eigen_embedding
-            eigen_embedding = eigen_embedding / torch.sqrt(self.kernel.normalizer) / sqrt(self.phase_order)
-            embeddings.append(eigen_embedding)
-        return torch.cat(embeddings, dim=1)
+        manifold = self.kernel.manifold
+        # only the phase functions entering the approximation are evaluated
+        phases_x = manifold.phase_functions(phase_x_inv, count=self.approx_order).real  # [order, num_phase * len(x)]
+        order = phases_x.shape[0]
+        scales = torch.sqrt(torch.abs(self.kernel.measure.variance[0]) * self.kernel.measure(self.kernel.lb_eigenvalues[:order]))
+        scales = scales / torch.sqrt(self.kernel.normalizer) / sqrt(self.phase_order)  # [order]
+        eigen_embeddings = phases_x.view(order, self.phase_order, len(x)) * scales[:, None, None]
+        # [len(x), order * num_phase], the embeddings of the eigenspaces one after another
+        return eigen_embeddings.permute(2, 0, 1).reshape(len(x), -1)
 
     def forward(self, x):  # [N, ...]
         embedding = self.make_embedding(x)
@@ -1,9 +1,9 @@
 import torch
+import numpy as np
 from abc import ABC, abstractmethod
 from lie_stationary_kernels.utils import lazy_property
-from lie_stationary_kernels.utils import cartesian_prod
+from lie_stationary_kernels.utils import pairwise_matmul
 import math
-import operator
 import warnings
 
 j = torch.tensor([1j]).item()  # imaginary unit
@@ -23,9 +23,21 @@ class AbstractManifold(ABC):
     def pairwise_diff(self, x, y):
         raise NotImplementedError
 
+    @lazy_property
+    def phase_functions(self):
+        phase_functions = self.compute_phase_functions()
+        return phase_functions
+
+    def compute_phase_functions(self):
+        """Collect the phase functions of all Laplace-Beltrami eigenspaces into a single module.
+        Calling it on x returns the values of the phase functions at x, stacked along the first dimension."""
+        return PhaseFunctions([eigenspace.phase_function for eigenspace in self.lb_eigenspaces])
+
 
 class CompactLieGroup(AbstractManifold, ABC):
     """Lie group abstract base class"""
+    error_est_tol = 1e-16
+
     def __init__(self, *, order: int):
         """
         Generate the list of signatures of representations and pick those with smallest LB eigenvalues.
@@ -33,19 +45,26 @@ class CompactLieGroup(AbstractManifold, ABC):
         """
         super().__init__()
         if order:
-            signatures = self.generate_signatures(order)
-            lb_eigenspaces = [self.Eigenspace(signature, manifold=self) for signature in signatures]
-            lb_eigenspaces.sort(key=operator.attrgetter('lb_eigenvalue'))
-            self.lb_eigenspaces = lb_eigenspaces[:order]
-            error_est = sum(math.exp(-irrep.lb_eigenvalue) * irrep.dimension**2 for irrep in lb_eigenspaces[order:])
+            signatures = np.array(self.generate_signatures(order))  # [N, rank]
+            # eigenvalues depend on the signature alone, so they are computed first
+            # and the eigenspaces are only constructed for the selected signatures
+            lb_eigenvalues = self.Eigenspace.lb_eigenvalues_of(signatures, self)
+            sorted_ind = np.argsort(lb_eigenvalues, kind='stable')
+            self.lb_eigenspaces = [self.Eigenspace(tuple(signature), manifold=self)
+                                   for signature in signatures[sorted_ind[:order]].tolist()]
+            # terms with the weight exp(-lambda) below the tolerance are negligible, skip computing their dimensions
+            weights = np.exp(-lb_eigenvalues[sorted_ind[order:]])
+            tail_ind = sorted_ind[order:][weights > self.error_est_tol]
+            dimensions = self.Eigenspace.dimensions_of(signatures[tail_ind], self)
+            error_est = np.sum(weights[weights > self.error_est_tol] * dimensions.astype(float) ** 2).item()
             if error_est > 1e-3:
                 warnings.warn('Heat kernel error est. {}, consider larger order of approximation.'.format(error_est), stacklevel=2)
         else:
             self.lb_eigenspaces = []
 
     @abstractmethod
-    def generate_signatures(self, order) -> list:
-        """Generate signatures of representations to enumerate them."""
+    def generate_signatures(self, order):
+        """Generate signatures of representations to enumerate them, as a sequence of tuples or a 2d array."""
         raise NotImplementedError
 
     @staticmethod
@@ -59,22 +78,26 @@ class CompactLieGroup(AbstractManifold, ABC):
         """Return the corresponding element of the standard maximal torus"""
         raise NotImplementedError
 
+    def compile_characters(self, **kwargs):
+        """Compiles the characters of all Laplace-Beltrami eigenspaces, see LieGroupCharacter.compile_chi.
+
+        With mode='reduce-overhead' the compiled characters are captured into CUDA graphs, one per input shape,
+        and repeated evaluations at the same number of points replay the graph in a single launch.
+        """
+        for eigenspace in self.lb_eigenspaces:
+            eigenspace.phase_function.compile_chi(**kwargs)
+        if isinstance(self.phase_functions, CharacterBatchEvaluator):
+            self.phase_functions.compile(**kwargs)
+
     def pairwise_diff(self, x, y, reverse=False):
         """If reverse is False for x of size n and y of size n computes x_i*y_j^{-1} and represent as array [n*m,...]
             if reverse is True then compute same but in this case for x_i^{-1}*y_j"""
         if not reverse:
             # computes xy^{-1}
-            y_inv = self.inv(y)
-            x_, y_ = cartesian_prod(x, y_inv)  # [n,m,d,d] and [n,m,d,d]
+            x_y_ = pairwise_matmul(x, self.inv(y))  # [n*m, d, d]
         else:
             # computes x^{-1}y
-            x_inv = self.inv(x)
-            x_, y_ = cartesian_prod(x_inv, y)  # [n,m,d,d] and [n,m,d,d]
-
-        x_flatten = torch.reshape(x_, (-1, self.n, self.n))
-        y_flatten = torch.reshape(y_, (-1, self.n, self.n))
-
-        x_y_ = torch.bmm(x_flatten, y_flatten)  # [n*m, ...]
+            x_y_ = pairwise_matmul(self.inv(x), y)  # [n*m, d, d]
         return x_y_
 
     def pairwise_embed(self, x, y):
@@ -169,9 +192,13 @@ class LBEigenspace(ABC):
         """
         self.index = index
         self.manifold = manifold
-        self.dimension = self.compute_dimension()
         self.lb_eigenvalue = self.compute_lb_eigenvalue()
 
+    @lazy_property
+    def dimension(self):
+        dimension = self.compute_dimension()
+        return dimension
+
     @abstractmethod
     def compute_dimension(self):
         """Compute the dimension of the Laplace-Beltrami eigenspace."""
@@ -240,6 +267,54 @@ class AveragedLBEigenspace(LBEigenspaceWithPhaseFunction):
         return AveragedLieGroupCharacter(self, self.manifold, self.initial_representation.compute_phase_function())
 
 
+class PhaseFunctions(torch.nn.ModuleList):
+    """Phase functions of several eigenspaces evaluated one after another"""
+    def forward(self, x, count=None):
+        # returns [count, ...], the first `count` phase functions (all by default), the same layout as the batch evaluators
+        return torch.stack([f(x) for f in self[:count]])
+
+
+class CharacterBatchEvaluator(torch.nn.Module):
+    """Several characters of a Lie group evaluated at the same torus elements in one pass.
+
+    Every character is an integer combination of the monomials exp(i<exponents, angles>). The exponents of all
+    characters are concatenated into one matrix [rank, M_total] and the coefficients, multiplied by the dimensions,
+    are laid out block-wise in a matrix [M_total, order]. All characters then come out of the same matrix products.
+    """
+    max_chunk_elements = 2 ** 18  # bounds the size of the intermediate tensor of monomial values
+
+    def __init__(self, characters):
+        """
+        :param characters: the characters, each having the real tensors `exponents` [rank, M] and `coeffs` [M]
+        """
+        super().__init__()
+        self.register_buffer('exponents', torch.cat([chi.exponents for chi in characters], dim=-1))  # [rank, M_total]
+        coeffs = torch.zeros((self.exponents.shape[-1], len(characters)),
+                             dtype=self.exponents.dtype, device=self.exponents.device)  # [M_total, order]
+        # the monomials of the character k are the columns offsets[k]:offsets[k+1]
+        self.offsets = np.cumsum([0] + [chi.coeffs.shape[0] for chi in characters]).tolist()
+        for k, chi in enumerate(characters):
+            coeffs[self.offsets[k]:self.offsets[k + 1], k] = chi.representation.dimension * chi.coeffs
+        self.register_buffer('coeffs', coeffs)
+
+    def forward(self, gammas, count=None):
+        # returns [count, *gammas.shape[:-1]], the same as LieGroupCharacter.forward for each of the first `count`
+        # characters (all by default); the monomials of the remaining characters are not evaluated
+        count = len(self.offsets) - 1 if count is None else min(count, len(self.offsets) - 1)
+        exponents = self.exponents[:, :self.offsets[count]]  # [rank, M]
+        coeffs = self.coeffs[:self.offsets[count], :count]  # [M, count]
+        angles = torch.angle(gammas).to(exponents.dtype)  # [..., rank]
+        angles_flatten = angles.reshape(-1, angles.shape[-1])
+        # in chunks of points, so that the [chunk, M] intermediate stays small
+        chunk = max(1, self.max_chunk_elements // max(1, exponents.shape[-1]))
+        values = []
+        for angles_chunk in torch.split(angles_flatten, chunk):
+            phases = angles_chunk @ exponents  # [chunk, M]
+            values.append(torch.complex(torch.cos(phases) @ coeffs, torch.sin(phases) @ coeffs))
+        values = torch.cat(values).T  # [count, num_points]
+        return values.reshape((-1,) + angles.shape[:-1])
+
+
 class LieGroupCharacter(torch.nn.Module, ABC):
     """Lie group representation character abstract base class"""
     def __init__(self, *, representation: LBEigenspace):
@@ -251,6 +326,14 @@ class LieGroupCharacter(torch.nn.Module, ABC):
         """Calculates the character value at an element of the maximal torus"""
         raise NotImplementedError
 
+    def compile_chi(self, **kwargs):
+        """Replaces chi by its torch.compile'd version, keyword arguments are passed to torch.compile.
+
+        All characters of a group share the code of chi and differ in the number of monomials only,
+        which torch.compile turns into a dynamic dimension after the first recompilation.
+        """
+        self.chi = torch.compile(self.chi, **kwargs)
+
     def evaluate(self, x):
         """Calculates the character value at an element of the group"""
         gammas = self.representation.manifold.torus_representative(x)
@@ -337,12 +420,7 @@ class NonCompactSymmetricSpace(AbstractManifold, ABC):
 
     def pairwise_diff(self, x, y):
         """for x of size n and y of size m computes x_i-y_j and represent as array [n*m,...]"""
-        y_inv = self.inv(y)
-        x_, y_ = cartesian_prod(x, y_inv)  # [n,m,d,d] and [n,m,d,d]
-        x_flatten = torch.reshape(x_, (-1, self.n, self.n))
-        y_flatten = torch.reshape(y_, (-1, self.n, self.n))
-
-        x_y_ = torch.bmm(x_flatten, y_flatten)  # [n*m, ...]
+        x_y_ = pairwise_matmul(x, self.inv(y))  # [n*m, d, d]
         return x_y_
 
 
@@ -2,7 +2,7 @@ import torch
 from lie_stationary_kernels.spaces.so import SO
 from lie_stationary_kernels.space import CompactHomogeneousSpace
 from geomstats.geometry.grassmannian import Grassmannian as Grassmannian_
-from lie_stationary_kernels.utils import cartesian_prod
+from lie_stationary_kernels.utils import pairwise_matmul
 
 
 dtype = torch.float64
@@ -78,7 +78,7 @@ class OrientedGrassmannian(CompactHomogeneousSpace, Grassmannian_):
         g = g * r_diag[:, None]
         diff = 2*(torch.all(torch.isclose(g[:, :, :self.m], x), dim=-1).type(dtype)-0.5)
         g = g * diff[..., None]
-        det_sign_g = torch.sign(torch.det(g))
+        det_sign_g = torch.linalg.slogdet(g).sign
         g[:, :, -1] *= det_sign_g[:, None]
         assert torch.allclose(x, g[:, :, :x.shape[-1]])
         assert torch.allclose(torch.det(g), torch.ones((g.shape[0],), dtype=dtype, device=device))
@@ -124,7 +124,7 @@ class Grassmannian(CompactHomogeneousSpace, Grassmannian_):
         g = g * r_diag[:, None]
         diff = 2*(torch.all(torch.isclose(g[:, :, :self.m], x), dim=-1).type(dtype)-0.5)
         g = g * diff[..., None]
-        det_sign_g = torch.sign(torch.det(g))
+        det_sign_g = torch.linalg.slogdet(g).sign
         g[:, :, -1] *= det_sign_g[:, None]
         assert torch.allclose(x, g[:, :, :x.shape[-1]])
         return g
@@ -136,17 +136,20 @@ class Grassmannian(CompactHomogeneousSpace, Grassmannian_):
 
     def dist(self, x, y):
         """from https://pymanopt.org/docs/latest/_modules/pymanopt/manifolds/grassmann.html"""
-        _, s, _ = torch.linalg.svd(torch.bmm(torch.transpose(x, dim0=-2, dim1=-1), y))
+        return self._dist_from_inner_products(torch.bmm(torch.transpose(x, dim0=-2, dim1=-1), y))
+
+    def pairwise_dist(self, x, y):
+        x_y = pairwise_matmul(torch.transpose(x, dim0=-2, dim1=-1), y)  # [n*m, m, m]
+        return self._dist_from_inner_products(x_y).reshape(x.shape[0], y.shape[0])
+
+    @staticmethod
+    def _dist_from_inner_products(x_y):
+        """The principal angles are the arccosines of the singular values of x^T y"""
+        _, s, _ = torch.linalg.svd(x_y)
         s[s > 1] = 1
         s = torch.arccos(s)
         return torch.linalg.norm(s, dim=1)
 
-    def pairwise_dist(self, x, y):
-        x_, y_ = cartesian_prod(x, y)
-        x_flatten = x_.reshape((-1, self.n, self.m))
-        y_flatten = y_.reshape((-1, self.n, self.m))
-        return self.dist(x_flatten, y_flatten).reshape(x.shape[0], y.shape[0])
-
     def close_to_id(self, x):
         x_ = x[:, :self.m, :self.m].reshape(x.shape[:-2] + (-1,))
         return torch.all(torch.isclose(x_, torch.zeros_like(x_)), dim=-1)
@@ -1,7 +1,6 @@
 import torch
 from lie_stationary_kernels.space import NonCompactSymmetricSpace
 from lie_stationary_kernels.spectral_measure import MaternSpectralMeasure, SqExpSpectralMeasure
-from lie_stationary_kernels.utils import cartesian_prod
 from math import sqrt
 from torch.distributions import Normal, StudentT
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -15,12 +14,18 @@ class HyperbolicSpace(NonCompactSymmetricSpace):
     """Ball model for Hyperbolic space formulas are taken from
      https://www.ams.org/journals/proc/1994-121-02/S0002-9939-1994-1186137-8/S0002-9939-1994-1186137-8.pdf"""
 
-    def __init__(self, n: int, order=10000):
+    def __init__(self, n: int, order=10000, dtype=dtype):
+        """
+        :param n: dimension of the space
+        :param order: the number of the random exponents
+        :param dtype: the floating point type of the points and of the kernel evaluation
+        """
         super(HyperbolicSpace, self).__init__()
         self.n = n
         self.dim = n
         self.order = order
-        self.id = torch.zeros(self.n, device=device, dtype=dtype).view(1, self.n)
+        self.dtype = dtype
+        self.id = torch.zeros(self.n, device=device, dtype=self.dtype).view(1, self.n)
         self.normalized_lmd = None
         #self.lb_eigenspaces = None
 
@@ -48,7 +53,7 @@ class HyperbolicSpace(NonCompactSymmetricSpace):
             scale = 1.0/torch.abs(measure.lengthscale[0])
         else:
             return NotImplementedError
-        lmd = self.normalized_lmd * scale
+        lmd = (self.normalized_lmd * scale).to(self.dtype)
         self.lb_eigenspaces = HypShiftedNormailizedExp(lmd, self.shift, self)
 
     def to_group(self, x):
@@ -57,14 +62,8 @@ class HyperbolicSpace(NonCompactSymmetricSpace):
     def pairwise_diff(self, x, y):
         """for x of size n and y of size m computes dist(x_i-y_j) and represents as array [n*m,...]"""
         """dist(x,y) = arccosh(1+2|x-y|^2/(1-|x|^2)(1-|y|^2)"""
-        x_, y_ = cartesian_prod(x, y) # [n,m,d] and [n,m,d]
-
-        x_flatten = torch.reshape(x_, (-1, self.n))
-        y_flatten = torch.reshape(y_, (-1, self.n))
-        xy_l2 = torch.sum(torch.square(x_flatten-y_flatten), dim=1)
-        x_l2, y_l2 = torch.sum((torch.square(x_flatten)), dim=1), torch.sum((torch.square(y_flatten)), dim=1)
-        xy_dist = torch.arccosh(1 + 2 * xy_l2/(1-x_l2)/(1-y_l2))
-        ones = torch.ones((xy_dist.size()[0], self.n), device=device, dtype=dtype)/sqrt(self.n)
+        xy_dist = self.pairwise_dist(x, y).reshape(-1)  # [n*m]
+        ones = torch.ones((xy_dist.size()[0], self.n), device=device, dtype=self.dtype)/sqrt(self.n)
         xy_diff = ones * torch.tanh(xy_dist/2)[:, None].clone()
         return xy_diff
 
@@ -72,15 +71,15 @@ class HyperbolicSpace(NonCompactSymmetricSpace):
         """Random point on hypersphere S^{n-1}"""
         if n == 0:
             return None
-        x = torch.randn(n, self.n, device=device, dtype=dtype)
-        x = x / torch.norm(x, dim=1, keepdim=True)
+        x = torch.randn(n, self.n, device=device, dtype=self.dtype)
+        x = x / torch.linalg.vector_norm(x, dim=1, keepdim=True)
         return x
 
     def rand(self, n=1):
         """Note, there is no standard method to sample from Hyperbolic space since Haar measure is infinite.
            We will sample from unit ball uniformly. """
         sphere = self.rand_phase(n)
-        r = torch.pow(torch.rand(n, device=device, dtype=dtype), 1/self.n)*0.99
+        r = torch.pow(torch.rand(n, device=device, dtype=self.dtype), 1/self.n)*0.99
         return sphere * r[:, None].clone()
 
     def inv(self, x):
@@ -89,20 +88,17 @@ class HyperbolicSpace(NonCompactSymmetricSpace):
 
     def _dist_to_id(self, x):
         """d(0,x) = log[(1+|x|)/(1-|x|)]"""
-        eucl_dist = torch.sqrt(torch.sum(torch.square(x), dim=1))
+        eucl_dist = torch.linalg.vector_norm(x, dim=1)
         exp_dist = (1+eucl_dist)/(1-eucl_dist)
         return torch.log(exp_dist)
 
     def pairwise_dist(self, x, y):
-        diff = self.pairwise_diff(x, y)
-        self._dist_to_id(diff).reshape(x.shape[0], y.shape[0])
-        x_, y_ = cartesian_prod(x, y) # [n,m,d] and [n,m,d]
-        x_flatten = torch.reshape(x_, (-1, self.n))
-        y_flatten = torch.reshape(y_, (-1, self.n))
-        xy_l2 = torch.sum(torch.square(x_flatten-y_flatten), dim=1)
-        x_l2, y_l2 = torch.sum((torch.square(x_flatten)), dim=1), torch.sum((torch.square(y_flatten)), dim=1)
-        xy_dist = torch.arccosh(1 + 2 * xy_l2/(1-x_l2)/(1-y_l2))
-        return xy_dist.reshape(x.shape[0], y.shape[0])
+        """dist(x,y) = arccosh(1+2|x-y|^2/(1-|x|^2)(1-|y|^2)"""
+        # |x-y|^2 is taken from the exact differences rather than |x|^2+|y|^2-2<x,y>, which cancels
+        # catastrophically and is amplified by the denominator near the boundary
+        x_sq, y_sq = torch.sum(x * x, dim=-1), torch.sum(y * y, dim=-1)  # [n] and [m]
+        xy_l2 = torch.square(torch.cdist(x, y, compute_mode='donot_use_mm_for_euclid_dist'))  # [n,m]
+        return torch.arccosh(1 + 2 * xy_l2/((1-x_sq[:, None])*(1-y_sq[None, :])))
 
 
 class HypShiftExp(torch.nn.Module):
@@ -113,19 +109,19 @@ class HypShiftExp(torch.nn.Module):
         self.lmd = lmd
         self.shift = shift
         self.manifold = manifold
-        self.rho = torch.tensor([(self.manifold.n-1)/2], device=device, dtype=dtype)[0]
+        self.register_buffer('rho', torch.tensor((self.manifold.n-1)/2, device=device, dtype=self.manifold.dtype))
+        self.register_buffer('lin_coef', -j * self.lmd + self.rho)  # [m], fixed for given lmd
 
     def forward(self, x):
         """e^{(-i\lambda+(n-1)/2)<x,b>} = ((1-|x|^2)/|x-b|^2)^{-i\lambda+(n-1)/2}"""
         """x --- [n,dim], shift --- [m, dim], lmd --- [m]"""
-        x_, shift_ = cartesian_prod(x, self.shift)  # both [n, m, dim]
-        x_flatten = x_.reshape((-1, self.manifold.n))
-        shift_flatten = shift_.reshape((-1, self.manifold.n))
-        x_shift_norm = torch.sum(torch.square(x_flatten - shift_flatten), dim=1)  # [n*m]
-        denominator = torch.log(x_shift_norm).reshape(x.size()[0], -1)  # log(|x_i-b_j|^2) --- [n,m]
-        numerator = torch.log(1-torch.sum(torch.square(x), dim=1))  # [n]
+        x_sq = torch.sum(x * x, dim=-1)  # [n]
+        # exact differences, the expansion |x|^2+|b|^2-2<x,b> loses all digits for x close to b
+        x_shift_norm = torch.square(torch.cdist(x, self.shift, compute_mode='donot_use_mm_for_euclid_dist'))
+        denominator = torch.log(x_shift_norm)  # log(|x_i-b_j|^2) --- [n,m]
+        numerator = torch.log(1-x_sq)  # [n]
         log_xb = numerator[:, None].clone() - denominator  # [n,m]
-        inner_prod = torch.einsum('nm,m-> nm', log_xb, -j * self.lmd + self.rho)  #[n,m]
+        inner_prod = log_xb * self.lin_coef  # [n,m]
         return torch.exp(inner_prod)
 
 
@@ -134,26 +130,27 @@ class HypShiftedNormailizedExp(torch.nn.Module):
         super().__init__()
         self.n = manifold.n
         if self.n % 2 == 0:
-            self.adds = torch.tensor([(2 * i + 1) ** 2 / 4 for i in range(self.n // 2 - 1)],
-                                     dtype=dtype, device=device)
+            adds = torch.tensor([(2 * i + 1) ** 2 / 4 for i in range(self.n // 2 - 1)],
+                                dtype=manifold.dtype, device=device)
         else:
-            self.adds = torch.tensor([i ** 2 for i in range(self.n // 2)],
-                                     dtype=dtype, device=device)
+            adds = torch.tensor([i ** 2 for i in range(self.n // 2)],
+                                dtype=manifold.dtype, device=device)
+        self.register_buffer('adds', adds)
         self.exp = HypShiftExp(lmd, shift, manifold)
-        self.coeff = self.c_function(lmd)  # (m,)
+        self.register_buffer('coeff', self.c_function(lmd))  # (m,)
 
     def c_function(self, lmd):
         lmd_sq = torch.square(lmd)  # (m, )
-        log_c = torch.log(lmd_sq[:, None].clone() + self.adds[None, :].clone())
-        log_c = torch.sum(log_c, dim=1)
+        # the product has only n//2 factors, so it is taken directly rather than through log-sum-exp
+        c = torch.sqrt(torch.prod(lmd_sq[:, None] + self.adds[None, :], dim=1))
         if self.n % 2 == 0:
-            log_c = log_c + torch.log(lmd) + torch.log(torch.tanh(pi * lmd))
-        return torch.squeeze(torch.exp(log_c/2))
+            c = c * torch.sqrt(lmd * torch.tanh(pi * lmd))
+        return torch.squeeze(c)
 
     def forward(self, x):
         #x = x.squeeze()
         # x has shape (n, dim,)
 
         exp = self.exp(x)  # (n, m)
-        return torch.einsum('nm,m->nm', exp, self.coeff)  # (n, m)
+        return exp * self.coeff  # (n, m)
 
@@ -1,7 +1,6 @@
 import json
 from typing import Union
-
-import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from so import SO, SOCharacter
 from su import SU, SUCharacter
@@ -96,25 +95,41 @@ groups = [
 # the number of representations to be calculated for each group
 order = 20
 
-characters = {}
-if not recalculate:
-    with open(storage_file_name, 'r') as file:
-        characters = json.load(file)
-
-for group_type, dim, character_class in groups:
-    group = group_type(n=dim, order=order)
-    group_name = '{}({})'.format(group_type.__name__, dim)
-    print(group_name)
-    if recalculate or (not recalculate and group_name not in characters):
-        characters[group_name] = {}
-    for irrep in group.lb_eigenspaces:
-        if str(irrep.index) not in characters[group_name]:
-            sys.stdout.write('{}: '.format(irrep.index))
-            character = character_class(representation=irrep, precomputed=False)
-            coeffs, monoms = character._compute_character_formula()
-            print(coeffs, monoms)
-            characters[group_name][str(irrep.index)] = (coeffs, monoms)
-
-with open(storage_file_name, 'w') as file:
-    json.dump(characters, file, cls=CompactJSONEncoder)
-# print(json.dumps(characters, cls=CompactJSONEncoder))
\ No newline at end of file
+def compute_character_formula(task):
+    """Compute the character parameters of a single representation, runs in a worker process"""
+    group_type, dim, character_class, signature = task
+    group = group_type(n=dim, order=0)  # order=0 skips enumerating the eigenspaces
+    irrep = group.Eigenspace(signature, manifold=group)
+    character = character_class(representation=irrep, precomputed=False)
+    if recalculate:
+        # do not reuse the results cached on disk, they may come from an older version of the computation
+        return character._compute_character_formula.__wrapped__(character)
+    return character._compute_character_formula()
+
+
+if __name__ == '__main__':
+    characters = {}
+    if not recalculate:
+        with open(storage_file_name, 'r') as file:
+            characters = json.load(file)
+
+    # the symbolic computations are independent, collect them all and distribute over the processes
+    tasks, task_keys = [], []
+    for group_type, dim, character_class in groups:
+        group = group_type(n=dim, order=order)
+        group_name = '{}({})'.format(group_type.__name__, dim)
+        if recalculate or (not recalculate and group_name not in characters):
+            characters[group_name] = {}
+        for irrep in group.lb_eigenspaces:
+            if str(irrep.index) not in characters[group_name]:
+                tasks.append((group_type, dim, character_class, irrep.index))
+                task_keys.append((group_name, str(irrep.index)))
+
+    with ProcessPoolExecutor() as executor:
+        for (group_name, index), (coeffs, monoms) in zip(task_keys, executor.map(compute_character_formula, tasks)):
+            print(group_name, index, coeffs, monoms)
+            characters[group_name][index] = (coeffs, monoms)
+
+    with open(storage_file_name, 'w') as file:
+        json.dump(characters, file, cls=CompactJSONEncoder)
+    # print(json.dumps(characters, cls=CompactJSONEncoder))
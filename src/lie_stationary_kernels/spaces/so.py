@@ -1,15 +1,12 @@
 import torch
 import numpy as np
-from lie_stationary_kernels.utils import fixed_length_partitions, partition_dominance_or_subpartition_cone
+from lie_stationary_kernels.utils import SO_sampler, eigvals_cpu, pfaffian, disk_cached_character_formula, load_character_formulas
 from lie_stationary_kernels.space import CompactLieGroup, LBEigenspaceWithBasis, LieGroupCharacter, TranslatedCharactersBasis
-from functools import reduce
-import operator
+from lie_stationary_kernels.space import CharacterBatchEvaluator
 import math
-import itertools
-import more_itertools
 import sympy
-from sympy.matrices.determinant import _det as sp_det
-import json
+from sympy.polys.rings import ring
+from sympy.polys.matrices import DomainMatrix
 from pathlib import Path
 
 dtype = torch.float64
@@ -20,10 +17,11 @@ class SO(CompactLieGroup):
     """
     SO(n), special orthogonal group of degree `n`.
     """
-    def __init__(self, n: int, order=20):
+    def __init__(self, n: int, order=20, dtype=dtype):
         """
         :param n: dimension of the space
         :param order: the order of approximation, the number of representations calculated
+        :param dtype: the floating point type of the group elements and of the character evaluation
         """
         if n <= 2 and order:
             raise ValueError("Dimensions 1, 2 are not supported")
@@ -31,12 +29,19 @@ class SO(CompactLieGroup):
         self.dim = n * (n-1) // 2
         self.rank = n // 2
         self.order = order
+        self.dtype = dtype
         self.Eigenspace = SOLBEigenspace
         if self.n % 2 == 0:
             self.rho = np.arange(self.rank-1, -1, -1)
         else:
             self.rho = np.arange(self.rank-1, -1, -1) + 0.5
-        self.id = torch.eye(self.n, device=device, dtype=dtype).view(1, self.n, self.n)
+        # the pairs of indices and the constant factor in the Weyl dimension formula, shared by all representations
+        self.weyl_pairs = np.triu_indices(self.rank, 1)
+        if self.n % 2 == 1:
+            self.weyl_const = 2 ** self.rank / math.prod(math.factorial(2 * k + 1) for k in range(self.rank))
+        else:
+            self.weyl_const = math.prod(2 / math.factorial(2 * k) for k in range(1, self.rank))
+        self.id = torch.eye(self.n, device=device, dtype=self.dtype).view(1, self.n, self.n)
         CompactLieGroup.__init__(self, order=order)
 
     def difference(self, x, y):
@@ -62,7 +67,7 @@ class SO(CompactLieGroup):
     def rand(self, num=1):
         if self.n == 2:
             # SO(2) = S^1
-            thetas = 2 * math.pi * torch.rand((num, 1), dtype=dtype, device=device)
+            thetas = 2 * math.pi * torch.rand((num, 1), dtype=self.dtype, device=device)
             c = torch.cos(thetas)
             s = torch.sin(thetas)
             r1 = torch.hstack((c, s)).unsqueeze(-2)
@@ -71,7 +76,7 @@ class SO(CompactLieGroup):
             return q
         elif self.n == 3:
             # explicit parametrization via the double cover SU(2) = S^3
-            sphere_point = torch.randn((num, 4), dtype=torch.double, device=device)
+            sphere_point = torch.randn((num, 4), dtype=self.dtype, device=device)
             sphere_point /= torch.linalg.vector_norm(sphere_point, dim=-1, keepdim=True)
             x, y, z, w = (sphere_point[..., i].unsqueeze(-1) for i in range(4))
             xx = x ** 2
@@ -91,13 +96,7 @@ class SO(CompactLieGroup):
             q = torch.cat((r1, r2, r3), -1)
             return q
         else:
-            h = torch.randn((num, self.n, self.n), device=device, dtype=dtype)
-            q, r = torch.linalg.qr(h)
-            r_diag_sign = torch.sign(torch.diagonal(r, dim1=-2, dim2=-1))
-            q *= r_diag_sign[:, None]
-            q_det_sign = torch.sign(torch.det(q))
-            q[:, :, 0] *= q_det_sign[:, None]
-            return q
+            return SO_sampler(num, self.n, dtype=self.dtype)
 
     def generate_signatures(self, order):
         """Generate the signatures of irreducible representations
@@ -106,19 +105,21 @@ class SO(CompactLieGroup):
         :param int order: number of eigenfunctions that will be returned
         :return signatures: signatures of representations likely having the smallest LB eigenvalues
         """
-        signatures = []
-        if self.n == 3:
-            signature_sum = 200
-        else:
-            signature_sum = 30
-        for signature_sum in range(0, signature_sum):
-            for i in range(0, self.rank + 1):
-                for signature in fixed_length_partitions(signature_sum, i):
-                    signature.extend([0] * (self.rank-i))
-                    signatures.append(tuple(signature))
-                    if self.n % 2 == 0 and signature[-1] != 0:
-                        signature[-1] = -signature[-1]
-                        signatures.append(tuple(signature))
+        max_sum = 200 if self.n == 3 else 30
+        # all non-increasing sequences of non-negative integers of length rank with the sum below max_sum,
+        # built column by column: each row is extended by every admissible value of the next entry
+        signatures = np.arange(max_sum)[:, None]
+        for _ in range(1, self.rank):
+            counts = np.minimum(signatures[:, -1], max_sum - 1 - signatures.sum(axis=1)) + 1
+            next_entry = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            signatures = np.column_stack((np.repeat(signatures, counts, axis=0), next_entry))
+        # order by the sum, then by the number of non-zero entries, then colexicographically
+        signatures = signatures[np.lexsort((*signatures.T, np.count_nonzero(signatures, axis=1), signatures.sum(axis=1)))]
+        if self.n % 2 == 0:
+            # each signature with a non-zero last entry is followed by the one with this entry negated
+            counts = 1 + (signatures[:, -1] != 0)
+            signatures = np.repeat(signatures, counts, axis=0)
+            signatures[(np.cumsum(counts) - 1)[counts == 2], -1] *= -1
         return signatures
 
     @staticmethod
@@ -130,9 +131,13 @@ class SO(CompactLieGroup):
     def close_to_id(x):
         d = x.shape[-1]  # x = [...,d,d]
         x_ = x.reshape(x.shape[:-2] + (-1,))  # [..., d * d]
-        eyes = torch.broadcast_to(torch.flatten(torch.eye(d, dtype=dtype, device=device)), x_.shape)  # [..., d * d]
+        eyes = torch.broadcast_to(torch.flatten(torch.eye(d, dtype=x.dtype, device=device)), x_.shape)  # [..., d * d]
         return torch.all(torch.isclose(x_, eyes, atol=1e-5), dim=-1)
 
+    def compute_phase_functions(self):
+        # all characters share the torus representatives, evaluate them at once
+        return CharacterBatchEvaluator([eigenspace.phase_function for eigenspace in self.lb_eigenspaces])
+
     def torus_representative(self, x):
         if self.n == 3:
             # In SO(3) the torus representative is determined by the non-trivial pair of eigenvalues,
@@ -143,28 +148,21 @@ class SO(CompactLieGroup):
             return torch.view_as_complex(torch.cat((real.unsqueeze(-1), imag.unsqueeze(-1)), -1)).unsqueeze(-1)
         elif self.n % 2 == 1:
             # In SO(2n+1) the torus representative is determined by the (unordered) non-trivial eigenvalues
-            eigvals = torch.linalg.eigvals(x)
+            eigvals = eigvals_cpu(x)
             sorted_ind = torch.sort(torch.view_as_real(eigvals), dim=-2).indices[..., 0]
             eigvals = torch.gather(eigvals, dim=-1, index=sorted_ind)
             gamma = eigvals[..., 0:-1:2]
             return gamma
         else:
-            # In SO(2n) each unordered set of eigenvalues determines two conjugacy classes
-            eigvals, eigvecs = torch.linalg.eig(x)
-            sorted_ind = torch.sort(torch.view_as_real(eigvals), dim=-2).indices[..., 0]
-            eigvals = torch.gather(eigvals, dim=-1, index=sorted_ind)
-            eigvecs = torch.gather(eigvecs, dim=-1, index=sorted_ind.unsqueeze(-2).broadcast_to(eigvecs.shape))
-            # c is a matrix transforming x into its canonical form (with 2x2 blocks)
-            c = torch.zeros_like(eigvecs)
-            c[..., ::2] = eigvecs[..., ::2] + eigvecs[..., 1::2]
-            c[..., 1::2] = (eigvecs[..., ::2] - eigvecs[..., 1::2])
-            # eigenvectors calculated by LAPACK are either real or purely imaginary, make everything real
-            # WARNING: might depend on the implementation of the eigendecomposition!
-            c = c.real + c.imag
-            # normalize s.t. det(c)≈±1, probably unnecessary
-            c /= math.sqrt(2)
-            torch.pow(eigvals[..., 0], torch.det(c).sgn(), out=eigvals[..., 0])
-            gamma = eigvals[..., ::2]
+            # In SO(2n) the rotation angles are determined up to sign by their cosines,
+            # which are the (pairwise equal) eigenvalues of the symmetric part of x
+            cos = torch.linalg.eigvalsh((x + torch.transpose(x, -2, -1)) / 2)[..., ::2]
+            sin = torch.sqrt(torch.clamp(1 - torch.square(cos), min=0))
+            # each unordered set of eigenvalues determines two conjugacy classes, told apart by the sign of
+            # the Pfaffian of the skew-symmetric part of x, which equals the product of the sines of the angles
+            pf_sign = torch.where(pfaffian((x - torch.transpose(x, -2, -1)) / 2) < 0, -1., 1.).to(sin.dtype)
+            sin[..., 0] *= pf_sign
+            gamma = torch.complex(cos, sin)
             return gamma
 
 
@@ -178,27 +176,45 @@ class SOLBEigenspace(LBEigenspaceWithBasis):
         super().__init__(signature, manifold=manifold)
 
     def compute_dimension(self):
-        signature = self.index
-        so = self.manifold
+        return self.dimension_of(self.index, self.manifold)
+
+    def compute_lb_eigenvalue(self):
+        return self.lb_eigenvalue_of(self.index, self.manifold)
+
+    @staticmethod
+    def dimension_of(signature, so: SO):
+        """The dimension of the representation with a given signature"""
+        return SOLBEigenspace.dimensions_of([signature], so)[0].item()
+
+    @staticmethod
+    def lb_eigenvalue_of(signature, so: SO):
+        """The Laplace-Beltrami eigenvalue of the representation with a given signature"""
+        return SOLBEigenspace.lb_eigenvalues_of([signature], so)[0].item()
+
+    @staticmethod
+    def dimensions_of(signatures, so: SO):
+        """The dimensions of the representations with given signatures, computed for all of them at once"""
+        sgn = np.array(signatures, dtype=float).reshape(-1, so.rank)
+        qs = sgn + so.rho
         if so.n % 2 == 1:
-            qs = [pk + so.rank - k - 1 / 2 for k, pk in enumerate(signature)]
-            rep_dim = reduce(operator.mul, (2 * qs[k] / math.factorial(2 * k + 1) for k in range(0, so.rank))) \
-                      * reduce(operator.mul, ((qs[i] - qs[j]) * (qs[i] + qs[j])
-                                              for i, j in itertools.combinations(range(so.rank), 2)), 1)
-            return int(round(rep_dim))
+            rep_dims = so.weyl_const * np.prod(qs, axis=-1)
         else:
-            qs = [pk + so.rank - k - 1 if k != so.rank - 1 else abs(pk) for k, pk in enumerate(signature)]
-            rep_dim = int(reduce(operator.mul, (2 / math.factorial(2 * k) for k in range(1, so.rank)))
-                          * reduce(operator.mul, ((qs[i] - qs[j]) * (qs[i] + qs[j])
-                                                  for i, j in itertools.combinations(range(so.rank), 2)), 1))
-            return int(round(rep_dim))
+            qs[:, -1] = np.abs(qs[:, -1])
+            rep_dims = np.full(len(sgn), so.weyl_const)
+        i, j = so.weyl_pairs
+        rep_dims *= np.prod((qs[:, i] - qs[:, j]) * (qs[:, i] + qs[:, j]), axis=-1)
+        return np.rint(rep_dims).astype(int)
 
-    def compute_lb_eigenvalue(self):
-        np_sgn = np.array(self.index)
-        rho = self.manifold.rho
+    @staticmethod
+    def lb_eigenvalues_of(signatures, so: SO):
+        """The Laplace-Beltrami eigenvalues of the representations with given signatures, computed for all of them at once"""
+        sgn = np.array(signatures, dtype=float).reshape(-1, so.rank)
+        rho = so.rho
         # killing_form_coeff = 4 * self.manifold.rank - (4 if self.manifold.n % 2 == 0 else 2)
-        lb_eigenvalue = (np.linalg.norm(rho + np_sgn) ** 2 - np.linalg.norm(rho) ** 2)  # / killing_form_coeff
-        return lb_eigenvalue.item()
+        # |sgn + rho|^2 - |rho|^2 = <sgn, sgn + 2 rho>, rho and the signatures are (half-)integers,
+        # so the sums are exact and equal eigenvalues tie exactly
+        lb_eigenvalues = np.sum(sgn * (sgn + 2 * rho), axis=-1)  # / killing_form_coeff
+        return lb_eigenvalues
 
     def compute_phase_function(self):
         return SOCharacter(representation=self)
@@ -208,86 +224,81 @@ class SOLBEigenspace(LBEigenspaceWithBasis):
 
 
 class SOCharacter(LieGroupCharacter):
+    max_chunk_elements = 2 ** 22  # bounds the size of the intermediate tensor of monomial values in chi
+
     def __init__(self, *, representation: SOLBEigenspace, precomputed=True):
         super().__init__(representation=representation)
+        # the characters are evaluated in the complex counterpart of the floating point type of the group
+        self.complex_dtype = torch.complex64 if representation.manifold.dtype == torch.float32 else torch.cdouble
+        self.real_dtype = torch.float32 if self.complex_dtype == torch.complex64 else torch.float64
         if precomputed:
             group_name = '{}({})'.format(self.representation.manifold.__class__.__name__, self.representation.manifold.n)
             file_path = Path(__file__).with_name('precomputed_characters.json')
-            with file_path.open('r') as file:
-                character_formulas = json.load(file)
-                try:
-                    cs, ms = character_formulas[group_name][str(self.representation.index)]
-                    self.coeffs, self.monoms = (torch.tensor(data, dtype=torch.int, device=device) for data in (cs, ms))
-                except KeyError as e:
-                    raise KeyError('Unable to retrieve character parameters for signature {} of {}, '
-                                   'perhaps it is not precomputed.'.format(e.args[0], group_name)) from None
+            character_formulas = load_character_formulas(file_path)
+            try:
+                cs, ms = character_formulas[group_name][str(self.representation.index)]
+                self.coeffs = torch.tensor(cs, dtype=self.real_dtype, device=device)  # [M]
+                self.monoms = torch.tensor(ms, dtype=torch.int16, device=device)  # [M, 2*rank], the exponents are small
+                # at most one of the exponents of g_i and gc_i = 1/g_i is non-zero, so a monomial is determined
+                # by their difference, the signed power of g_i; stored in the form consumed by chi, cast once
+                rank = self.representation.manifold.rank
+                self.exponents = (self.monoms[:, :rank] - self.monoms[:, rank:]).T.to(self.real_dtype)  # [rank, M]
+            except KeyError as e:
+                raise KeyError('Unable to retrieve character parameters for signature {} of {}, '
+                               'perhaps it is not precomputed.'.format(e.args[0], group_name)) from None
 
+    @disk_cached_character_formula
     def _compute_character_formula(self):
         n = self.representation.manifold.n
         rank = self.representation.manifold.rank
         signature = self.representation.index
-        gammas = sympy.symbols(' '.join('g{}'.format(i + 1) for i in range(rank)))
-        gammas = list(more_itertools.always_iterable(gammas))
-        gammas_conj = sympy.symbols(' '.join('gc{}'.format(i + 1) for i in range(rank)))
-        gammas_conj = list(more_itertools.always_iterable(gammas_conj))
-        chi_variables = gammas + gammas_conj
+        # the Weyl character formula, chi = numer/denom, where numer and denom are alternants in the torus
+        # coordinates (in their square roots for odd n) and their inverses;
+        # multiplying the row i of an alternant by g_i^{max(qs)} makes it a polynomial, and the division exact
+        poly_ring, *gammas = ring(' '.join('g{}'.format(i + 1) for i in range(rank)), sympy.ZZ)
+
+        def alternant(qs, sign):
+            k = max(qs)
+            mat = [[gammas[i] ** (k + q) + sign * gammas[i] ** (k - q) for q in qs] for i in range(rank)]
+            return DomainMatrix(mat, (rank, rank), poly_ring.to_domain()).det()
+
         if n % 2:
-            gammas_sqrt = sympy.symbols(' '.join('gr{}'.format(i + 1) for i in range(rank)))
-            gammas_sqrt = list(more_itertools.always_iterable(gammas_sqrt))
-            gammas_conj_sqrt = sympy.symbols(' '.join('gcr{}'.format(i + 1) for i in range(rank)))
-            gammas_conj_sqrt = list(more_itertools.always_iterable(gammas_conj_sqrt))
-            chi_variables = gammas_sqrt + gammas_conj_sqrt
-            def xi1(qs):
-                mat = sympy.Matrix(rank, rank, lambda i, j: gammas_sqrt[i]**qs[j]-gammas_conj_sqrt[i]**qs[j])
-                return sympy.Poly(sp_det(mat, method='berkowitz'), chi_variables)
-            # qs = [sympy.Integer(2*pk + 2*rank - 2*k - 1) / 2 for k, pk in enumerate(signature)]
             qs = [2 * pk + 2 * rank - 2 * k - 1 for k, pk in enumerate(signature)]
-            # denom_pows = [sympy.Integer(2*k - 1) / 2 for k in range(rank, 0, -1)]
-            denom_pows = [2 * k - 1 for k in range(rank, 0, -1)]
-            numer = xi1(qs)
-            denom = xi1(denom_pows)
+            denom_qs = [2 * k - 1 for k in range(rank, 0, -1)]
+            numer = alternant(qs, -1)
+            denom = alternant(denom_qs, -1)
         else:
-            def xi0(qs):
-                mat = sympy.Matrix(rank, rank, lambda i, j: gammas[i] ** qs[j] + gammas_conj[i] ** qs[j])
-                return sympy.Poly(sp_det(mat, method='berkowitz'), chi_variables)
-            def xi1(qs):
-                mat = sympy.Matrix(rank, rank, lambda i, j: gammas[i] ** qs[j] - gammas_conj[i] ** qs[j])
-                return sympy.Poly(sp_det(mat, method='berkowitz'), chi_variables)
             qs = [pk + rank - k - 1 if k != rank - 1 else abs(pk) for k, pk in enumerate(signature)]
+            denom_qs = list(reversed(range(rank)))
+            numer = alternant(qs, 1)
             pm = signature[-1]
-            numer = xi0(qs)
             if pm:
-                numer += (1 if pm > 0 else -1) * xi1(qs)
-            denom = xi0(list(reversed(range(rank))))
-        partition = tuple(map(abs, self.representation.index)) + tuple([0] * self.representation.manifold.rank)
-        monomials_tuples = itertools.chain.from_iterable(
-            more_itertools.distinct_permutations(p) for p in partition_dominance_or_subpartition_cone(partition)
-        )
-        monomials_tuples = filter(lambda p: all(p[i] == 0 or p[i + rank] == 0 for i in range(rank)), monomials_tuples)
-        monomials_tuples = list(monomials_tuples)
-        monomials = [sympy.polys.monomials.Monomial(m, chi_variables).as_expr()
-                     for m in monomials_tuples]
-        chi_coeffs = list(more_itertools.always_iterable(
-            sympy.symbols(' '.join('c{}'.format(i) for i in range(1, len(monomials) + 1)))))
-        exponents = [n % 2 + 1] * len(monomials)  # the correction s.t. chi is the same polynomial for both oddities of n
-        chi_poly = sympy.Poly(sum(c * m**d for c, m, d in zip(chi_coeffs, monomials, exponents)), chi_variables)
-        pr = chi_poly * denom - numer
-        if n % 2:
-            pr = sympy.Poly(pr.subs((g*gc, 1) for g, gc in zip(gammas_sqrt, gammas_conj_sqrt)), chi_variables)
-        else:
-            pr = sympy.Poly(pr.subs((g*gc, 1) for g, gc in zip(gammas, gammas_conj)), chi_variables)
-        sol = list(sympy.linsolve(pr.coeffs(), chi_coeffs)).pop()
-        if n % 2:
-            chi_variables = gammas + gammas_conj
-            chi_poly = sympy.Poly(chi_poly.subs([gr ** 2, g] for gr, g in zip(gammas_sqrt + gammas_conj_sqrt, chi_variables)), chi_variables)
-        p = sympy.Poly(chi_poly.subs((c, c_val) for c, c_val in zip(chi_coeffs, sol)), chi_variables)
+                numer += (1 if pm > 0 else -1) * alternant(qs, -1)
+            denom = alternant(denom_qs, 1)
+        quotient = numer.exquo(denom)
+        # undo the multiplication by the powers of g_i, negative powers of g_i are positive powers of gc_i = 1/g_i,
+        # for odd n the exponents are even and halved to pass from the square roots to the coordinates themselves
+        shift, halve = max(qs) - max(denom_qs), 1 + n % 2
+        terms = {}
+        for monom, coeff in quotient.terms():
+            exps = [(e - shift) // halve for e in monom]
+            terms[tuple(max(e, 0) for e in exps) + tuple(max(-e, 0) for e in exps)] = int(coeff)
+        chi_variables = sympy.symbols(' '.join('g{}'.format(i + 1) for i in range(rank)) + ' ' +
+                                      ' '.join('gc{}'.format(i + 1) for i in range(rank)))
+        p = sympy.Poly.from_dict(terms, chi_variables)
         coeffs = list(map(int, p.coeffs()))
         monoms = [list(map(int, monom)) for monom in p.monoms()]
         return coeffs, monoms
 
     def chi(self, gammas):
-        gammas = torch.cat((gammas, gammas.conj()), dim=-1)
-        char_val = torch.zeros(gammas.shape[:-1], dtype=torch.cdouble, device=device)
-        for coeff, monom in zip(self.coeffs, self.monoms):
-            char_val += coeff * torch.prod(gammas ** monom, dim=-1)
+        # the torus coordinates lie on the unit circle, so the monomials are exp(i<exponents, angles>),
+        # the phases of all monomials are computed by a single real matrix product
+        angles = torch.angle(gammas).to(self.real_dtype)  # [..., rank]
+        # in chunks if the [..., M] intermediate gets too large
+        chunk = max(1, self.max_chunk_elements // angles[..., 0].numel())
+        char_val = torch.zeros(angles.shape[:-1], dtype=self.complex_dtype, device=device)
+        for coeffs, exponents in zip(torch.split(self.coeffs, chunk), torch.split(self.exponents, chunk, dim=-1)):
+            phases = angles @ exponents  # [..., chunk]
+            # the coefficients are real, sum the real and the imaginary parts of the monomials separately
+            char_val += torch.complex(torch.cos(phases) @ coeffs, torch.sin(phases) @ coeffs)
         return char_val
@@ -1,7 +1,7 @@
 import torch
 from lie_stationary_kernels.space import NonCompactSymmetricSpace, NonCompactSymmetricSpaceExp
 from lie_stationary_kernels.spectral_measure import MaternSpectralMeasure, SqExpSpectralMeasure
-from lie_stationary_kernels.utils import GOE_sampler, triu_ind, cartesian_prod
+from lie_stationary_kernels.utils import GOE_sampler, SO_sampler, pairwise_matmul
 from math import factorial
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -46,13 +46,7 @@ class SymmetricPositiveDefiniteMatrices(NonCompactSymmetricSpace):
         return torch.linalg.cholesky(x, upper=True)
 
     def rand_phase(self, n=1):
-        qr = torch.randn((n, self.n, self.n),device=device, dtype=dtype)
-        q, r = torch.linalg.qr(qr)
-        r_diag_sign = torch.sign(torch.diagonal(r, dim1=-2, dim2=-1))
-        q *= r_diag_sign[:, None]
-        q_det_sign = torch.sign(torch.det(q))
-        q[:, :, 0] *= q_det_sign[:, None]
-        return q
+        return SO_sampler(n, self.n)
 
     def rand(self, n=1):
         """Note, there is no standard method to sample from SPD
@@ -74,9 +68,7 @@ class SymmetricPositiveDefiniteMatrices(NonCompactSymmetricSpace):
 
     def pairwise_dist(self, x, y):
         x_G, y_G_inv = self.to_group(x), self.inv(self.to_group(y))
-        x_, y_ = cartesian_prod(x_G, y_G_inv)
-        x_, y_ = x_.reshape(-1, self.n, self.n), y_.reshape(-1, self.n, self.n)
-        x_y_ = torch.bmm(x_, y_)
+        x_y_ = pairwise_matmul(x_G, y_G_inv)  # [n*m, dim, dim]
         return self._dist_to_id(x_y_).reshape(x.shape[0], y.shape[0])
 
 
@@ -92,16 +84,14 @@ class SPDShiftExp(NonCompactSymmetricSpaceExp):
         def iwasawa_decomposition(self, x):
             h, an = torch.linalg.qr(x, mode='complete')
 
-            diag_sign = torch.diag_embed(torch.diagonal(torch.sign(an), dim1=-2, dim2=-1))
-            h = torch.bmm(h, diag_sign)
-            an = torch.bmm(diag_sign, an)
+            # multiplication by diagonal matrices is done by broadcasting over rows/columns
+            diag_sign = torch.sign(torch.diagonal(an, dim1=-2, dim2=-1))
+            h = h * diag_sign[..., None, :]
+            an = an * diag_sign[..., :, None]
 
             a = torch.diagonal(an, dim1=-2, dim2=-1)
 
-            a_inv = torch.div(torch.ones_like(a), a)
-            a_inv = torch.diag_embed(a_inv)
-
-            n = torch.bmm(a_inv, an)
+            n = an / a[..., :, None]
 
             return h, a, n
 
@@ -111,14 +101,20 @@ class SPDShiftedNormailizedExp(torch.nn.Module):
         super().__init__()
         self.n = manifold.n
         self.exp = SPDShiftExp(lmd, shift, manifold)
-        self.coeff = self.c_function_tanh(lmd)  # (m,)
+        triu_i, triu_j = torch.triu_indices(self.n, self.n, 1, device=lmd.device)
+        # buffers follow the module to another device together with the rest of its state
+        self.register_buffer('triu_i', triu_i)
+        self.register_buffer('triu_j', triu_j)
+        self.register_buffer('coeff', self.c_function_tanh(lmd))  # (m,)
 
     def c_function_tanh(self, lmd):
-        lmd_ = (lmd[:, None, :] - lmd[:, :, None])[triu_ind(lmd.size()[0], self.n, 1)].reshape(-1,
-                                                                                       self.n * (self.n - 1) // 2)
-        lmd_ = pi * torch.abs(lmd_)
-        lmd_ = torch.tanh(lmd_)
-        c_function_tanh = torch.sum(torch.log(lmd_), dim=1)
+        # pairwise differences lmd_j - lmd_i, i < j, indexed on the last two dimensions only
+        # instead of materializing a mask of the shape (m, n, n)
+        lmd_ = (lmd[:, None, :] - lmd[:, :, None])[:, self.triu_i, self.triu_j]  # (m, n(n-1)/2)
+        lmd_ = 2 * pi * torch.abs(lmd_)
+        # log(tanh(x/2)) = log(1 - e^{-x}) - log(1 + e^{-x}), stays accurate where tanh rounds to 1
+        log_tanh = torch.log(-torch.expm1(-lmd_)) - torch.nn.functional.softplus(-lmd_)
+        c_function_tanh = torch.sum(log_tanh, dim=1)
 
         return torch.exp(c_function_tanh/2)
 
@@ -126,5 +122,5 @@ class SPDShiftedNormailizedExp(torch.nn.Module):
         # x has shape (n, dim, dim)
 
         exp = self.exp(x)  # (n, m)
-        return torch.einsum('nm,m->nm', exp, self.coeff)  # (n, m)
+        return exp * self.coeff  # (n, m)
 
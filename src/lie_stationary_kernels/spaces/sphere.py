@@ -2,10 +2,8 @@ import torch
 import numpy as np
 from scipy.special import loggamma
 
-from lie_stationary_kernels.utils import cartesian_prod
 from lie_stationary_kernels.space import AbstractManifold, LBEigenspaceWithBasis
 from geomstats.geometry.hypersphere import Hypersphere
-from torch.autograd.functional import _vmap as vmap
 from spherical_harmonics.spherical_harmonics import SphericalHarmonicsLevel
 from spherical_harmonics.fundamental_set import FundamentalSystemCache
 from spherical_harmonics.spherical_harmonics import num_harmonics
@@ -18,90 +16,101 @@ class Sphere(AbstractManifold, Hypersphere):
     """
     S^{dim} sphere, in R^{dim+1}
     """
-    def __init__(self, n: int, order=10):
+    def __init__(self, n: int, order=10, dtype=dtype):
         """
         :param dim: sphere dimension
         :param order: the order of approximation, the umber of Laplace-Beltrami eigenspaces under consideration.
+        :param dtype: the floating point type of the points and of the kernel evaluation
         """
         self.n = n
         self.dim = n
         self.order = order
+        self.dtype = dtype
         AbstractManifold.__init__(self)
         Hypersphere.__init__(self, self.n)
 
         self.fundamental_system = FundamentalSystemCache(self.n + 1)
         self.lb_eigenspaces = [SphereLBEigenspace(index, manifold=self) for index in range(0, self.order)]
 
-        self.id = torch.zeros((self.n+1,), device=device, dtype=dtype).view(1, self.n+1)
+        self.id = torch.zeros((self.n+1,), device=device, dtype=self.dtype).view(1, self.n+1)
         self.id[0][0] = 1.0
 
     def dist(self, x, y):
-        return torch.arccos(torch.dot(x, y))
+        # x, y -- [..., d+1], the inner product is clipped against rounding for (nearly) coinciding points
+        return torch.arccos(torch.clip(torch.sum(x * y, dim=-1), -1.0, 1.0))
 
     def rand(self, n=1):
         if n == 0:
             return None
-        x = torch.randn(n, self.n + 1, dtype=dtype, device=device)
-        x = x / torch.norm(x, dim=1, keepdim=True)
+        x = torch.randn(n, self.n + 1, dtype=self.dtype, device=device)
+        x = x / torch.linalg.vector_norm(x, dim=1, keepdim=True)
         return x
 
     def pairwise_embed(self, x, y):
         # x -- [n,d+1]
         # y -- [m, d+1]
-        x_, y_ = cartesian_prod(x, y)
-        x_flatten = torch.reshape(x_, (-1, self.n+1))
-        y_flatten = torch.reshape(y_, (-1, self.n+1))
-        return vmap(torch.dot)(x_flatten, y_flatten)
+        return x @ y.transpose(-1, -2)  # [n, m]
 
     def pairwise_dist(self, x, y):
-        return torch.abs(torch.arccos(self.pairwise_embed(x, y))).reshape((x.shape[0], y.shape[0]))
+        return torch.arccos(torch.clip(self.pairwise_embed(x, y), -1.0, 1.0))
+
+    def compute_phase_functions(self):
+        # all zonal functions share the argument, evaluate them at once
+        zonals = [eigenspace.phase_function for eigenspace in self.lb_eigenspaces]
+        return GegenbauerBatchEvaluator(alpha=(self.dim - 1) / 2., degrees=[zonal.gegenbauer.n for zonal in zonals],
+                                        scales=[zonal.const[0] for zonal in zonals], dtype=self.dtype)
 
 
 class ProjectiveSpace(AbstractManifold, Hypersphere):
     """
     S^{dim} sphere, in R^{dim+1}
     """
-    def __init__(self, n: int, order=10):
+    def __init__(self, n: int, order=10, dtype=dtype):
         """
         :param dim: sphere dimension
         :param order: the order of approximation, the umber of Laplace-Beltrami eigenspaces under consideration.
+        :param dtype: the floating point type of the points and of the kernel evaluation
         """
         self.n = n
         self.dim = n
         self.order = order
+        self.dtype = dtype
         AbstractManifold.__init__(self)
         Hypersphere.__init__(self, self.n)
 
         self.fundamental_system = FundamentalSystemCache(self.n + 1)
         self.lb_eigenspaces = [SphereLBEigenspace(2*index, manifold=self) for index in range(0, self.order)]
 
-        self.id = torch.zeros((self.n+1,), device=device, dtype=dtype).view(1, self.n+1)
+        self.id = torch.zeros((self.n+1,), device=device, dtype=self.dtype).view(1, self.n+1)
         self.id[0][0] = 1.0
 
     def dist(self, x, y):
-        great_circle_dist = torch.arccos(torch.clip(torch.dot(x, y), -1, 1))
-        dist = torch.min(great_circle_dist, pi-great_circle_dist)
-        return dist
+        # x, y -- [..., d+1]
+        great_circle_dist = torch.arccos(torch.clip(torch.sum(x * y, dim=-1), -1.0, 1.0))
+        return torch.minimum(great_circle_dist, pi-great_circle_dist)
 
     def rand(self, n=1):
         if n == 0:
             return None
-        x = torch.randn(n, self.n + 1, dtype=dtype, device=device)
-        x = x / torch.norm(x, dim=1, keepdim=True)
+        x = torch.randn(n, self.n + 1, dtype=self.dtype, device=device)
+        x = x / torch.linalg.vector_norm(x, dim=1, keepdim=True)
         return x
 
     def pairwise_embed(self, x, y):
         # x -- [n,d+1]
         # y -- [m, d+1]
-        x_, y_ = cartesian_prod(x, y)
-        x_flatten = torch.reshape(x_, (-1, self.n+1))
-        y_flatten = torch.reshape(y_, (-1, self.n+1))
-        return vmap(torch.dot)(x_flatten, y_flatten)
+        return x @ y.transpose(-1, -2)  # [n, m]
 
     def pairwise_dist(self, x, y):
         x_dot_y = torch.clip(self.pairwise_embed(x, y), -1.0, 1.0)
         x_y_ = torch.arccos(x_dot_y)
-        return torch.min(x_y_, pi-x_y_).reshape((x.shape[0], y.shape[0]))
+        return torch.min(x_y_, pi-x_y_)
+
+    def compute_phase_functions(self):
+        # all zonal functions share the argument, evaluate them at once
+        zonals = [eigenspace.phase_function for eigenspace in self.lb_eigenspaces]
+        return GegenbauerBatchEvaluator(alpha=(self.dim - 1) / 2., degrees=[zonal.gegenbauer.n for zonal in zonals],
+                                        scales=[zonal.const[0] for zonal in zonals], dtype=self.dtype)
 
 
 class SphereLBEigenspace(LBEigenspaceWithBasis):
@@ -121,69 +130,91 @@ class SphereLBEigenspace(LBEigenspaceWithBasis):
         return n * (self.manifold.dim + n - 1)
 
     def compute_phase_function(self):
-        return ZonalSphericalFunction(self.manifold.dim, self.index)
+        return ZonalSphericalFunction(self.manifold.dim, self.index, dtype=self.manifold.dtype)
 
     def compute_basis(self):
-        return NormalizedSphericalFunctions(self.manifold.dim, self.index, self.manifold.fundamental_system)
+        return NormalizedSphericalFunctions(self.manifold.dim, self.index, self.manifold.fundamental_system,
+                                            dtype=self.manifold.dtype)
 
 
 class NormalizedSphericalFunctions(torch.nn.Module):
-    def __init__(self, dimension, degree, fundamental_system):
+    def __init__(self, dimension, degree, fundamental_system, dtype=dtype):
         super().__init__()
         self.spherical_functions = SphericalHarmonicsLevel(dimension + 1, degree, fundamental_system)
         # 2 * S_{dim}/dim^2
         self.const = np.sqrt(2/(dimension+1)) *\
                      np.exp((np.log(np.pi) * (dimension + 1) / 2 - loggamma((dimension + 1) / 2)) / 2)
+        # the harmonics are the Gegenbauer zonals at the fundamental system V, orthonormalized by L^{-1},
+        # evaluate them directly in torch to avoid a host round-trip on every call
+        self.gegenbauer = GegenbauerPolynomials(alpha=(dimension - 1) / 2., n=degree, dtype=dtype)
+        self.register_buffer('fundamental_points',
+                             torch.tensor(self.spherical_functions.V, dtype=dtype, device=device))  # [M, d+1]
+        self.register_buffer('orthonormalizer',
+                             torch.tensor(self.spherical_functions.L_inv, dtype=dtype, device=device))  # [M, M]
 
     def forward(self, x):
-        # this is truly barbaric, but until https://github.com/vdutor/SphericalHarmonics/issues/9 is resolved...
-        return self.spherical_functions(x.cpu()).to(device)
+        # x -- [n, d+1]
+        zonals = self.gegenbauer.forward_batch(self.fundamental_points @ x.T)  # [M, n]
+        return self.orthonormalizer @ zonals  # [M, n]
 
 
 class ZonalSphericalFunction(torch.nn.Module):
-    def __init__(self, dim, n):
+    def __init__(self, dim, n, dtype=dtype):
         super().__init__()
-        self.gegenbauer = GegenbauerPolynomials(alpha=(dim - 1) / 2., n=n)
-        self.forward = vmap(self._forward)
+        self.gegenbauer = GegenbauerPolynomials(alpha=(dim - 1) / 2., n=n, dtype=dtype)
 
         if n == 0:
-            self.const = torch.tensor([1.])
+            const = torch.ones(1, dtype=dtype, device=device)
         else:
             log_d_n = np.log(2*n+dim-1) + loggamma(n+dim-1) - loggamma(dim) - loggamma(n+1)
-            self.const = torch.tensor([np.exp(log_d_n)/self.gegenbauer(1.0)])
+            const = np.exp(log_d_n)/self.gegenbauer.forward_batch(torch.ones(1, dtype=dtype, device=device))
+        self.register_buffer('const', const)
+
+    def forward(self, dist):
+        return self.gegenbauer.forward_batch(dist) * self.const[0]
 
-    def _forward(self, dist):
-        return self.gegenbauer(dist) * self.const[0]
+
+def gegenbauer_recurrence(x, alpha, max_n):
+    """The Gegenbauer polynomials C_0, ..., C_{max_n} with parameter alpha, evaluated elementwise at x
+    via the three-term recurrence n C_n(x) = 2(n+alpha-1) x C_{n-1}(x) - (n+2alpha-2) C_{n-2}(x), see Abramowitz & Stegun
+    """
+    polys = [torch.ones_like(x), 2 * alpha * x]
+    for n in range(2, max_n + 1):
+        polys.append((2 * (n + alpha - 1) * x * polys[-1] - (n + 2 * alpha - 2) * polys[-2]) / n)
+    return polys
 
 
 class GegenbauerPolynomials(torch.nn.Module):
-    def __init__(self, alpha, n):
+    def __init__(self, alpha, n, dtype=dtype):
         super().__init__()
         self.alpha = alpha
         self.n = n
-        self.coefficients = self.compute_coefficients()
-        self.powers = torch.arange(0., self.n + 1., dtype=dtype, device=device)
-
-    def compute_coefficients(self):
-        coefficients = torch.zeros(self.n + 1, dtype=dtype, device=device)
-        # Two first polynomials is quite pretty
-        # C_0 = 1, C_1 = 2\alpha*x
-        if self.n == 0:
-            coefficients[0] = 1
-        if self.n == 1:
-            coefficients[1] = 2 * self.alpha
-        if self.n >= 2:
-            # Other polynimials are given in Abramowitz & Stegun
-            # c_{n-2k} = (-1)^k * 2^{n-2k} \Gamma(n-k+\alpha)/(\Gamma(\alpha)*k!(n-2k)!)
-            for k in range(0, self.n // 2 + 1):
-                sgn = (-1) ** k
-                log_coeff = (self.n - 2 * k) * np.log(2) + loggamma(self.n - k + self.alpha) \
-                            - loggamma(self.alpha) - loggamma(k + 1) - loggamma(self.n - 2 * k + 1)
-                coeff = sgn * np.exp(log_coeff)
-                coefficients[self.n - 2 * k] = coeff
-        return coefficients
+        self.dtype = dtype
 
-    def forward(self, x):
-        # returns \sum c_i * x^i
-        x_pows = torch.pow(x, self.powers)
-        return torch.dot(x_pows, self.coefficients)
+    def forward_batch(self, x):
+        # returns C_n(x) elementwise for x of any shape; unlike Horner's scheme on the monomial coefficients,
+        # the recurrence does not sum large alternating terms
+        return gegenbauer_recurrence(x, self.alpha, self.n)[self.n]
+
+
+class GegenbauerBatchEvaluator(torch.nn.Module):
+    """Several scaled Gegenbauer polynomials with a common alpha evaluated at the same points in one pass"""
+    def __init__(self, alpha, degrees, scales, dtype=dtype):
+        """
+        :param alpha: the parameter alpha of the polynomials
+        :param degrees: the degrees of the polynomials
+        :param scales: the constants the polynomials are multiplied by
+        :param dtype: the floating point type of the evaluation
+        """
+        super().__init__()
+        self.alpha = alpha
+        self.degrees = list(degrees)
+        self.register_buffer('scales', torch.as_tensor(scales, dtype=dtype, device=device))  # [order]
+
+    def forward(self, x, count=None):
+        # returns [count, *x.shape] for the first `count` polynomials (all by default),
+        # the polynomials of all degrees up to their largest one are computed by one recurrence
+        degrees, scales = self.degrees[:count], self.scales[:count]
+        polys = gegenbauer_recurrence(x, self.alpha, max(degrees))
+        values = torch.stack([polys[n] for n in degrees])  # [count, *x.shape]
+        return values * scales.reshape(scales.shape + (1,) * x.dim())
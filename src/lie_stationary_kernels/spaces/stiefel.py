@@ -42,7 +42,7 @@ class Stiefel(CompactHomogeneousSpace, Stiefel_):
         g = g * r_diag[:, None]
         diff = 2*(torch.all(torch.isclose(g[:, :, :self.m], x), dim=-1).type(dtype)-0.5)
         g = g * diff[..., None]
-        det_sign_g = torch.sign(torch.det(g))
+        det_sign_g = torch.linalg.slogdet(g).sign
         g[:, :, -1] *= det_sign_g[:, None]
         assert torch.allclose(x, g[:, :, :x.shape[-1]])
         return g
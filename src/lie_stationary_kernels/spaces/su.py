@@ -1,15 +1,12 @@
 import torch
 import numpy as np
 from lie_stationary_kernels.space import CompactLieGroup, LBEigenspaceWithBasis, LieGroupCharacter, TranslatedCharactersBasis
-from functools import reduce
-import operator
+from lie_stationary_kernels.space import CharacterBatchEvaluator
 import math
-import itertools
-import more_itertools
-from lie_stationary_kernels.utils import partition_dominance_cone
+from lie_stationary_kernels.utils import eigvals_cpu, disk_cached_character_formula, load_character_formulas
 import sympy
-from sympy.matrices.determinant import _det as sp_det
-import json
+from sympy.polys.rings import ring
+from sympy.polys.matrices import DomainMatrix
 from pathlib import Path
 
 dtype = torch.cdouble
@@ -21,19 +18,24 @@ class SU(CompactLieGroup):
     """
     SU(n), special unitary group of degree `n`.
     """
-    def __init__(self, n: int, order=10):
+    def __init__(self, n: int, order=10, dtype=dtype):
         """
         :param n: dimension of the space
         :param order: the order of approximation, the number of representations calculated
+        :param dtype: the complex floating point type of the group elements and of the character evaluation
         """
         self.n = n
         self.dim = n*n-1
         self.rank = n-1
         self.order = order
+        self.dtype = dtype
         self.Eigenspace = SULBEigenspace
 
         self.rho = np.arange(self.n - 1, -self.n, -2) * 0.5
-        self.id = torch.eye(self.n, device=device, dtype=dtype).view(1, self.n, self.n)
+        # the pairs of indices and the constant factor in the Weyl dimension formula, shared by all representations
+        self.weyl_pairs = np.triu_indices(self.n, 1)
+        self.weyl_const = 1 / math.prod(math.factorial(k) for k in range(1, self.n))
+        self.id = torch.eye(self.n, device=device, dtype=self.dtype).view(1, self.n, self.n)
         super().__init__(order=order)
 
     def dist(self, x, y):
@@ -51,17 +53,20 @@ class SU(CompactLieGroup):
             r1 = torch.hstack((a, -b.conj())).unsqueeze(-1)
             r2 = torch.hstack((b, a.conj())).unsqueeze(-1)
             q = torch.cat((r1, r2), -1)
-            return q
+            return q.to(self.dtype)
         else:
-            h = torch.randn((num, self.n, self.n), dtype=dtype, device=device)
-            q, r = torch.linalg.qr(h)
-            r_diag = torch.diagonal(r, dim1=-2, dim2=-1)
-            r_diag_inv_phase = torch.conj(r_diag / torch.abs(r_diag))
-            q *= r_diag_inv_phase[:, None]
-            q_det = torch.det(q)
-            q_det_inv_phase = torch.conj(q_det / torch.abs(q_det))
-            q[:, :, 0] *= q_det_inv_phase[:, None]
-            return q
+            # the decomposition is done in double precision regardless of the type of the group elements
+            h = torch.randn((num, self.n, self.n), dtype=torch.cdouble, device=device)
+            # the QR decomposition in the Householder form, q is the product of the reflectors I - tau v v^H
+            a, tau = torch.geqrf(h)
+            q = torch.linalg.householder_product(a, tau)
+            r_diag = torch.diagonal(a, dim1=-2, dim2=-1)
+            # q*diag(conj(phase(diag(r)))) is Haar-distributed on U(n), dividing its first column by its determinant
+            # lands in SU(n); the determinant of a reflector is -tau/conj(tau) (1 if tau = 0), so no det is needed
+            phases = torch.conj(r_diag / torch.abs(r_diag))  # [num, n]
+            reflector_dets = torch.where(tau == 0, torch.ones_like(tau), -tau / torch.conj(tau))  # [num, n]
+            phases[:, 0] *= torch.conj(torch.prod(reflector_dets, dim=-1) * torch.prod(phases, dim=-1))
+            return (q * phases[:, None, :]).to(self.dtype)
 
     def generate_signatures(self, order):
         """Generate the signatures of irreducible representations
@@ -71,10 +76,16 @@ class SU(CompactLieGroup):
         :return signatures: signatures of representations likely having the smallest LB eigenvalues
         """
         sign_vals_lim = 100 if self.n in (1, 2) else 30 if self.n == 3 else 10
-        signatures = list(itertools.combinations_with_replacement(range(sign_vals_lim, -1, -1), r=self.rank))
-        signatures = [sgn + (0,) for sgn in signatures]
-        signatures.sort()
-        return signatures
+        # all non-increasing sequences of integers in [0, sign_vals_lim] of length rank, followed by zero,
+        # built column by column: each row is extended by every admissible value of the next entry
+        signatures = np.zeros((1, 0), dtype=int)
+        for _ in range(self.rank):
+            counts = (signatures[:, -1] if signatures.shape[1] else np.array([sign_vals_lim])) + 1
+            next_entry = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            signatures = np.column_stack((np.repeat(signatures, counts, axis=0), next_entry))
+        signatures = np.column_stack((signatures, np.zeros(len(signatures), dtype=int)))
+        # in the lexicographic order
+        return signatures[np.lexsort(signatures.T[::-1])]
 
     @staticmethod
     def inv(x: torch.Tensor):
@@ -85,11 +96,21 @@ class SU(CompactLieGroup):
     def close_to_id(x):
         d = x.shape[-1]  # x = [...,d,d]
         x_ = x.reshape(x.shape[:-2] + (-1,))  # [..., d * d]
-        eyes = torch.broadcast_to(torch.flatten(torch.eye(d, dtype=dtype, device=device)), x_.shape)  # [..., d * d]
+        eyes = torch.broadcast_to(torch.flatten(torch.eye(d, dtype=x.dtype, device=device)), x_.shape)  # [..., d * d]
         return torch.all(torch.isclose(x_, eyes, atol=1e-5), dim=-1)
 
+    def compute_phase_functions(self):
+        # all characters share the torus representatives, evaluate them at once
+        return CharacterBatchEvaluator([eigenspace.phase_function for eigenspace in self.lb_eigenspaces])
+
     def torus_representative(self, x):
-        return torch.linalg.eigvals(x)
+        if self.n == 2:
+            # In SU(2) the eigenvalues are exp(+-i theta), cos(theta) is half the trace and |sin(theta)| is read off
+            # the anti-Hermitian part of x, whose eigenvalues are +-i sin(theta), which stays accurate near the identity
+            cos = torch.einsum('...ii->...', x).real / 2
+            sin = torch.linalg.matrix_norm(x - x.mH) / (2 * math.sqrt(2))
+            return torch.stack((torch.complex(cos, sin), torch.complex(cos, -sin)), dim=-1)
+        return eigvals_cpu(x)
 
     def pairwise_dist(self, x, y):
         """For n points x_i and m points y_j computed dist(x_i,y_j)
@@ -114,20 +135,39 @@ class SULBEigenspace(LBEigenspaceWithBasis):
         super().__init__(signature, manifold=manifold)
 
     def compute_dimension(self):
-        signature = self.index
-        su = self.manifold
-        rep_dim = reduce(operator.mul, (reduce(operator.mul, (signature[i - 1] - signature[j - 1] + j - i for j in
-                                                              range(i + 1, su.n + 1))) / math.factorial(su.n - i)
-                                        for i in range(1, su.n)))
-        return int(round(rep_dim))
+        return self.dimension_of(self.index, self.manifold)
 
     def compute_lb_eigenvalue(self):
-        sgn = np.array(self.index, dtype=float)
-        # transform the signature into the same basis as rho
-        sgn -= np.mean(sgn)
-        rho = self.manifold.rho
-        lb_eigenvalue = (np.linalg.norm(rho + sgn) ** 2 - np.linalg.norm(rho) ** 2)  # / (2 * self.manifold.n)
-        return lb_eigenvalue.item()
+        return self.lb_eigenvalue_of(self.index, self.manifold)
+
+    @staticmethod
+    def dimension_of(signature, su: SU):
+        """The dimension of the representation with a given signature"""
+        return SULBEigenspace.dimensions_of([signature], su)[0].item()
+
+    @staticmethod
+    def lb_eigenvalue_of(signature, su: SU):
+        """The Laplace-Beltrami eigenvalue of the representation with a given signature"""
+        return SULBEigenspace.lb_eigenvalues_of([signature], su)[0].item()
+
+    @staticmethod
+    def dimensions_of(signatures, su: SU):
+        """The dimensions of the representations with given signatures, computed for all of them at once"""
+        sgn = np.array(signatures, dtype=float).reshape(-1, su.n)
+        i, j = su.weyl_pairs
+        rep_dims = su.weyl_const * np.prod(sgn[:, i] - sgn[:, j] + j - i, axis=-1)
+        return np.rint(rep_dims).astype(int)
+
+    @staticmethod
+    def lb_eigenvalues_of(signatures, su: SU):
+        """The Laplace-Beltrami eigenvalues of the representations with given signatures, computed for all of them at once"""
+        sgn = np.array(signatures, dtype=float).reshape(-1, su.n)
+        rho = su.rho
+        # |sgn - mean(sgn) + rho|^2 - |rho|^2, the signatures are transformed into the same basis as rho;
+        # written as an integer over n, s.t. the eigenvalues of conjugate representations tie exactly
+        numer = su.n * np.sum(sgn ** 2, axis=-1) - np.sum(sgn, axis=-1) ** 2 + su.n * (sgn @ (2 * rho))
+        lb_eigenvalues = numer / su.n  # / (2 * su.n)
+        return lb_eigenvalues
 
     def compute_phase_function(self):
         return SUCharacter(representation=self)
@@ -137,43 +177,55 @@ class SULBEigenspace(LBEigenspaceWithBasis):
 
 
 class SUCharacter(LieGroupCharacter):
+    max_chunk_elements = 2 ** 22  # bounds the size of the intermediate tensor of monomial values in chi
+
     def __init__(self, *, representation: SULBEigenspace, precomputed=True):
         super().__init__(representation=representation)
+        # the characters are evaluated in the complex type of the group elements
+        self.complex_dtype = representation.manifold.dtype
+        self.real_dtype = torch.float32 if self.complex_dtype == torch.complex64 else torch.float64
         if precomputed:
             group_name = '{}({})'.format(self.representation.manifold.__class__.__name__,
                                          self.representation.manifold.n)
             file_path = Path(__file__).with_name('precomputed_characters.json')
-            with file_path.open('r') as file:
-                character_formulas = json.load(file)
-                try:
-                    cs, ms = character_formulas[group_name][str(self.representation.index)]
-                    self.coeffs, self.monoms = (torch.tensor(data, dtype=torch.int, device=device) for data in (cs, ms))
-                except KeyError as e:
-                    raise KeyError('Unable to retrieve character parameters for signature {} of {}, '
-                                   'perhaps it is not precomputed.'.format(e.args[0], group_name)) from None
-
+            character_formulas = load_character_formulas(file_path)
+            try:
+                cs, ms = character_formulas[group_name][str(self.representation.index)]
+                self.coeffs = torch.tensor(cs, dtype=self.real_dtype, device=device)  # [M]
+                self.monoms = torch.tensor(ms, dtype=torch.int16, device=device)  # [M, n], the exponents are small
+                # stored in the form consumed by chi, cast once
+                self.exponents = self.monoms.T.to(self.real_dtype)  # [n, M]
+            except KeyError as e:
+                raise KeyError('Unable to retrieve character parameters for signature {} of {}, '
+                               'perhaps it is not precomputed.'.format(e.args[0], group_name)) from None
+
+    @disk_cached_character_formula
     def _compute_character_formula(self):
         n = self.representation.manifold.n
-        gammas = sympy.symbols(' '.join('g{}'.format(i) for i in range(1, n + 1)))
+        # the Weyl character formula, chi = numer/denom, where numer is the alternant det(g_i^{q_j}) and denom is
+        # the Vandermonde determinant; the quotient is the Schur polynomial, computed by exact polynomial division
+        poly_ring, *gammas = ring(' '.join('g{}'.format(i + 1) for i in range(n)), sympy.ZZ)
+
+        def alternant(qs):
+            mat = [[gammas[i] ** q for q in qs] for i in range(n)]
+            return DomainMatrix(mat, (n, n), poly_ring.to_domain()).det()
+
         qs = [pk + n - k - 1 for k, pk in enumerate(self.representation.index)]
-        numer_mat = sympy.Matrix(n, n, lambda i, j: gammas[i]**qs[j])
-        numer = sympy.Poly(sp_det(numer_mat, method='berkowitz'))
-        denom = sympy.Poly(sympy.prod(gammas[i] - gammas[j] for i, j in itertools.combinations(range(n), r=2)))
-        monomials_tuples = list(itertools.chain.from_iterable(
-            more_itertools.distinct_permutations(p) for p in partition_dominance_cone(self.representation.index)
-        ))
-        monomials = [sympy.polys.monomials.Monomial(m, gammas).as_expr() for m in monomials_tuples]
-        chi_coeffs = list(more_itertools.always_iterable(sympy.symbols(' '.join('c{}'.format(i) for i in range(1, len(monomials) + 1)))))
-        chi_poly = sympy.Poly(sum(c * m for c, m in zip(chi_coeffs, monomials)), gammas)
-        pr = chi_poly * denom - numer
-        sol = list(sympy.linsolve(pr.coeffs(), chi_coeffs)).pop()
-        p = sympy.Poly(sum(c * m for c, m in zip(sol, monomials)), gammas)
+        quotient = alternant(qs).exquo(alternant(list(reversed(range(n)))))
+        chi_variables = sympy.symbols(' '.join('g{}'.format(i + 1) for i in range(n)))
+        p = sympy.Poly.from_dict({monom: int(coeff) for monom, coeff in quotient.terms()}, chi_variables)
         coeffs = list(map(int, p.coeffs()))
         monoms = [list(map(int, monom)) for monom in p.monoms()]
         return coeffs, monoms
 
     def chi(self, gammas):
-        char_val = torch.zeros(gammas.shape[:-1], dtype=dtype, device=device)
-        for coeff, monom in zip(self.coeffs, self.monoms):
-            char_val += coeff * torch.prod(gammas ** monom, dim=-1)
+        # the torus coordinates lie on the unit circle and the coefficients are integers, so the monomials are
+        # exp(i<monom, angles>) and the character is assembled from real matrix products only
+        angles = torch.angle(gammas).to(self.real_dtype)  # [..., n]
+        # in chunks if the [..., M] intermediate gets too large
+        chunk = max(1, self.max_chunk_elements // angles[..., 0].numel())
+        char_val = torch.zeros(gammas.shape[:-1], dtype=self.complex_dtype, device=device)
+        for coeffs, exponents in zip(torch.split(self.coeffs, chunk), torch.split(self.exponents, chunk, dim=-1)):
+            phases = angles @ exponents  # [..., chunk]
+            char_val += torch.complex(torch.cos(phases) @ coeffs, torch.sin(phases) @ coeffs)
         return char_val
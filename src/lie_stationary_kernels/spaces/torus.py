@@ -1,4 +1,5 @@
 import torch
+import numpy as np
 from lie_stationary_kernels.space import CompactLieGroup, LBEigenspaceWithPhaseFunction, LieGroupCharacter
 import math
 import itertools
@@ -77,10 +78,26 @@ class TorusLBEigenspace(LBEigenspaceWithPhaseFunction):
         super().__init__(index, manifold=manifold)
 
     def compute_dimension(self):
-        return 1
+        return self.dimension_of(self.index, self.manifold)
 
     def compute_lb_eigenvalue(self):
-        return 4*math.pi*math.pi*sum([x**2 for x in self.index])
+        return self.lb_eigenvalue_of(self.index, self.manifold)
+
+    @staticmethod
+    def dimension_of(signature, torus: Torus):
+        return 1
+
+    @staticmethod
+    def lb_eigenvalue_of(signature, torus: Torus):
+        return 4*math.pi*math.pi*sum([x**2 for x in signature])
+
+    @staticmethod
+    def dimensions_of(signatures, torus: Torus):
+        return np.ones(len(signatures), dtype=int)
+
+    @staticmethod
+    def lb_eigenvalues_of(signatures, torus: Torus):
+        return 4*math.pi*math.pi*np.sum(np.square(np.array(signatures, dtype=float).reshape(-1, torus.n)), axis=-1)
 
     def compute_phase_function(self):
         return TorusCharacter(representation=self)
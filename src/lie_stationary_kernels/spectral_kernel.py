@@ -2,7 +2,6 @@ from abc import ABC, abstractmethod
 
 import torch
 import math
-from itertools import islice
 
 from lie_stationary_kernels.spectral_measure import AbstractSpectralMeasure
 from lie_stationary_kernels.space import AbstractManifold
@@ -26,6 +25,9 @@ class AbstractSpectralKernel(torch.nn.Module, ABC):
 class EigenbasisSumKernel(AbstractSpectralKernel):
     def __init__(self, measure, manifold):
         super().__init__(measure, manifold)
+        self.phase_functions = manifold.phase_functions  # registered as a submodule, so that .to() reaches it
+        lb_eigenvalues = [eigenspace.lb_eigenvalue for eigenspace in manifold.lb_eigenspaces]
+        self.register_buffer('lb_eigenvalues', torch.tensor(lb_eigenvalues, dtype=dtype, device=device))  # [order]
 
         point = manifold.rand()
         self.normalizer = self.forward(point, point, normalize=False)[0, 0]
@@ -43,11 +45,9 @@ class EigenbasisSumKernel(AbstractSpectralKernel):
                 self.compute_normalizer()
 
         x_y_embed = self.manifold.pairwise_embed(x, y)
-        cov = torch.zeros(len(x), len(y), dtype=dtype, device=device)
-        for eigenspace in self.manifold.lb_eigenspaces:
-            lmd = eigenspace.lb_eigenvalue
-            f = eigenspace.phase_function
-            cov += self.measure(lmd) * f(x_y_embed).view(x.size()[0], y.size()[0]).real
+        f_x_y = self.phase_functions(x_y_embed).real.to(dtype)  # [order, n*m]
+        # the sum over the eigenspaces of the spectral measure times the phase functions is a single product
+        cov = (self.measure(self.lb_eigenvalues) @ f_x_y.reshape(len(self.lb_eigenvalues), -1)).view(len(x), len(y))
         if normalize:
             return torch.abs(self.measure.variance[0]) * cov/self.normalizer
         else:
@@ -82,6 +82,9 @@ class RandomPhaseKernel(AbstractSpectralKernel):
         self.approx_order = manifold.order
         self.phase_order = phase_order
         self.phases = self.sample_phases()
+        self.phase_functions = manifold.phase_functions  # registered as a submodule, so that .to() reaches it
+        lb_eigenvalues = [eigenspace.lb_eigenvalue for eigenspace in manifold.lb_eigenspaces]
+        self.register_buffer('lb_eigenvalues', torch.tensor(lb_eigenvalues, dtype=dtype, device=device))  # [order]
 
         point = self.manifold.rand()
         self.normalizer = self.forward(point, point, normalize=False)[0, 0]
@@ -94,19 +97,17 @@ class RandomPhaseKernel(AbstractSpectralKernel):
         return self.manifold.rand(self.phase_order)
 
     def make_embedding(self, x):
-        embeddings = []
         phases = self.phases  # [num_phase, ...]
         # left multiplication
         phase_x_inv = self.manifold.pairwise_embed(phases, x)  # [len(x), num_phase, ...]
 
-        for i, eigenspace in enumerate(islice(self.manifold.lb_eigenspaces, self.approx_order)):
-            lmd = eigenspace.lb_eigenvalue
-            f = eigenspace.phase_function
-            eigen_embedding = f(phase_x_inv).real.view(self.phase_order, x.size()[0]).T
-            eigen_embedding = torch.sqrt(self.measure(lmd)) * eigen_embedding
-            eigen_embedding = eigen_embedding / math.sqrt(self.phase_order)
-            embeddings.append(eigen_embedding)
-        return torch.cat(embeddings, dim=1)
+        # only the phase functions entering the approximation are evaluated
+        phases_x = self.phase_functions(phase_x_inv, count=self.approx_order).real  # [order, num_phase * len(x)]
+        order = phases_x.shape[0]
+        scales = torch.sqrt(self.measure(self.lb_eigenvalues[:order])) / math.sqrt(self.phase_order)  # [order]
+        eigen_embeddings = phases_x.view(order, self.phase_order, len(x)) * scales[:, None, None]
+        # [len(x), order * num_phase], the embeddings of the eigenspaces one after another
+        return eigen_embeddings.permute(2, 0, 1).reshape(len(x), -1)
 
     def forward(self, x, y=None, normalize=True):
         if y is None:
@@ -154,11 +155,12 @@ class RandomSpectralKernel(AbstractSpectralKernel):
         x_yinv_embed = f(x_yinv)  # (n*m,order)
         eye_embed = f(self.manifold.id)  # (1, order)
         cov_flatten = x_yinv_embed @ (torch.conj(eye_embed).T)
-        cov = cov_flatten.view(x.size()[0], y.size()[0])
+        # the manifold may evaluate the kernel in lower precision, the covariance is handed over in float64
+        cov = cov_flatten.view(x.size()[0], y.size()[0]).real.to(dtype)
         if normalize:
-            return self.measure.variance[0] * cov.real / self.normalizer
+            return self.measure.variance[0] * cov / self.normalizer
         else:
-            return cov.real
+            return cov
 
 
 class RandomFourierFeatureKernel(AbstractSpectralKernel):
@@ -182,8 +184,9 @@ class RandomFourierFeatureKernel(AbstractSpectralKernel):
             y = x
 
         x_, y_ = self.manifold.to_group(x), self.manifold.to_group(y)
-        x_embed = self.manifold.lb_eigenspaces(x_)
-        y_embed = self.manifold.lb_eigenspaces(y_)
+        # the manifold may evaluate the features in lower precision, the covariance is formed in float64
+        x_embed = self.manifold.lb_eigenspaces(x_).to(torch.complex128)
+        y_embed = self.manifold.lb_eigenspaces(y_).to(torch.complex128)
 
         if normalize:
             x_embed = torch.sqrt(torch.abs(self.measure.variance[0]))*x_embed/torch.sqrt(self.normalizer)
@@ -1,4 +1,8 @@
 import torch
+import os
+import json
+import functools
+from pathlib import Path
 
 dtype = torch.float64
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -11,6 +15,64 @@ def GOE_sampler(num_samples, n):
     return eigenvalues
 
 
+def SO_sampler(num_samples, n, dtype=dtype):
+    '''
+    Haar-distributed random elements of SO(n), obtained from the QR decomposition of Gaussian matrices.
+    On CUDA small matrices are decomposed by LAPACK on the host, which is faster than the batched MAGMA path.
+    :return: tensor of the shape [num_samples,n,n]
+    '''
+    h = torch.randn((num_samples, n, n), device=device, dtype=dtype)
+    if h.device.type != 'cpu' and n <= 8:
+        h = h.cpu()
+    # the QR decomposition in the Householder form, q is the product of the reflectors I - tau v v^T
+    a, tau = torch.geqrf(h)
+    q = torch.linalg.householder_product(a, tau)
+    # q*diag(sign(diag(r))) is Haar-distributed on O(n), flipping its first column by its determinant lands in SO(n),
+    # both corrections are one column scaling; a reflector has the determinant -1 unless tau = 0 and it is the identity
+    signs = torch.sign(torch.diagonal(a, dim1=-2, dim2=-1))  # [num_samples, n]
+    signs[:, 0] *= torch.prod(signs, dim=-1) * torch.prod(torch.where(tau == 0, 1., -1.).to(signs.dtype), dim=-1)
+    return (q * signs[:, None, :]).to(device, non_blocking=True)
+
+
+def eigvals_cpu(x: torch.Tensor):
+    '''
+    Eigenvalues of a batch of general square matrices, computed by LAPACK on the host.
+    On CUDA torch.linalg.eigvals goes through MAGMA, which copies to the host anyway and is slow for small matrices.
+    :param x: tensor of the shape [...,d,d]
+    :return: eigenvalues [...,d] on the device of x
+    '''
+    if x.device.type == 'cpu':
+        return torch.linalg.eigvals(x)
+    return torch.linalg.eigvals(x.cpu()).to(x.device, non_blocking=True)
+
+
+def pfaffian(x: torch.Tensor):
+    '''
+    Pfaffian of a batch of skew-symmetric matrices, computed by the Parlett-Reid elimination with pivoting.
+    :param x: tensor of the shape [...,2m,2m]
+    :return: tensor of the shape [...]
+    '''
+    x = x.clone()
+    d = x.shape[-1]
+    pf = torch.ones(x.shape[:-2], dtype=x.dtype, device=x.device)
+    for k in range(0, d - 1, 2):
+        # swap the row/column k+1 with the one holding the largest element of the k-th column
+        pivot = k + 1 + torch.argmax(torch.abs(x[..., k+1:, k]), dim=-1)  # [...]
+        perm = torch.arange(d, device=x.device).expand(x.shape[:-1]).clone()  # [...,2m]
+        perm.scatter_(-1, pivot.unsqueeze(-1), k + 1)
+        perm[..., k+1] = pivot
+        x = torch.gather(x, -2, perm.unsqueeze(-1).expand(x.shape))
+        x = torch.gather(x, -1, perm.unsqueeze(-2).expand(x.shape))
+        pf = pf * torch.where(pivot == k + 1, 1., -1.).to(x.dtype) * x[..., k, k+1]
+        if k + 2 < d:
+            # a zero pivot means a zero Pfaffian, avoid dividing by it
+            denom = torch.where(x[..., k, k+1] == 0, torch.ones_like(pf), x[..., k, k+1])
+            tau = x[..., k, k+2:] / denom.unsqueeze(-1)  # [...,2m-k-2]
+            col = x[..., k+2:, k+1]  # [...,2m-k-2]
+            x[..., k+2:, k+2:] += tau.unsqueeze(-1) * col.unsqueeze(-2) - col.unsqueeze(-1) * tau.unsqueeze(-2)
+    return pf
+
+
 def triu_ind(m, n, offset):
     a = torch.ones(m, n, n)
     triu_indices = a.triu(diagonal=offset).nonzero().transpose(0, 1)
@@ -52,48 +114,17 @@ def cartesian_prod(x1: torch.Tensor, x2: torch.Tensor) -> torch.Tensor:
     return x1_, x2_
 
 
-def fixed_length_partitions(n, L):
-    """
-    https://www.ics.uci.edu/~eppstein/PADS/IntegerPartitions.py
-    Integer partitions of n into L parts, in colex order.
-    The algorithm follows Knuth v4 fasc3 p38 in rough outline;
-    Knuth credits it
-     to Hindenburg, 1779.
-    """
-
-    # guard against special cases
-    if L == 0:
-        if n == 0:
-            yield []
-        return
-    if L == 1:
-        if n > 0:
-            yield [n]
-        return
-    if n < L:
-        return
-
-    partition = [n - L + 1] + (L - 1) * [1]
-    while True:
-        yield partition.copy()
-        if partition[0] - 1 > partition[1]:
-            partition[0] -= 1
-            partition[1] += 1
-            continue
-        j = 2
-        s = partition[0] + partition[1] - 1
-        while j < L and partition[j] >= partition[0] - 1:
-            s += partition[j]
-            j += 1
-        if j >= L:
-            return
-        partition[j] = x = partition[j] + 1
-        j -= 1
-        while j > 0:
-            partition[j] = x
-            s -= x
-            j -= 1
-        partition[0] = s
+def pairwise_matmul(x1: torch.Tensor, x2: torch.Tensor) -> torch.Tensor:
+    '''
+    Products of all pairs of matrices from two batches, computed as a single matrix product
+    :param x1: tensor of the shape [a,d,k]
+    :param x2: tensor of the shape [b,k,e]
+    :return: tensor of the shape [a*b,d,e], whose element i*b+j is x1_i @ x2_j
+    '''
+    a, d, k = x1.shape
+    b, _, e = x2.shape
+    prod = x1.reshape(a * d, k) @ x2.transpose(0, 1).reshape(k, b * e)  # [a*d, b*e], block (i,j) is x1_i @ x2_j
+    return prod.reshape(a, d, b, e).transpose(1, 2).reshape(a * b, d, e)
 
 
 def hook_content_formula(lmd, n):
@@ -109,63 +140,6 @@ def hook_content_formula(lmd, n):
     return numer/denom
 
 
-def partition_dominance_cone(partition):
-    '''
-    Calculates partitions dominated by a given one
-    and having the same number of parts (including zero parts of the original)
-    '''
-    cone = {partition}
-    new_partitions = {0}
-    prev_partitions = cone
-    while new_partitions:
-        new_partitions = set()
-        for partition in prev_partitions:
-            for i in range(len(partition) - 1):
-                if partition[i] > partition[i + 1]:
-                    for j in range(i + 1, len(partition)):
-                        if partition[i] > partition[j] + 1 and partition[j] < partition[j - 1]:
-                            new_partition = list(partition)
-                            new_partition[i] -= 1
-                            new_partition[j] += 1
-                            new_partition = tuple(new_partition)
-                            if new_partition not in cone:
-                                new_partitions.add(new_partition)
-        cone.update(new_partitions)
-        prev_partitions = new_partitions
-    return cone
-
-
-def partition_dominance_or_subpartition_cone(partition):
-    '''
-        Calculates subpartitions and partitions dominated by a given one
-        and having the same number of parts (including zero parts of the original)
-        '''
-    cone = {partition}
-    new_partitions = {0}
-    prev_partitions = cone
-    while new_partitions:
-        new_partitions = set()
-        for partition in prev_partitions:
-            for i in range(len(partition) - 1):
-                if partition[i] > partition[i + 1]:
-                    new_partition = list(partition)
-                    new_partition[i] -= 1
-                    new_partition = tuple(new_partition)
-                    if new_partition not in cone:
-                        new_partitions.add(new_partition)
-                    for j in range(i + 1, len(partition)):
-                        if partition[i] > partition[j] + 1 and partition[j] < partition[j - 1]:
-                            new_partition = list(partition)
-                            new_partition[i] -= 1
-                            new_partition[j] += 1
-                            new_partition = tuple(new_partition)
-                            if new_partition not in cone:
-                                new_partitions.add(new_partition)
-        cone.update(new_partitions)
-        prev_partitions = new_partitions
-    return cone
-
-
 def lazy_property(fn):
     """Decorator that makes a property lazy-evaluated."""
     attr_name = '_lazy_' + fn.__name__
@@ -178,6 +152,46 @@ def lazy_property(fn):
     return _lazy_property
 
 
+@functools.lru_cache(maxsize=None)
+def load_character_formulas(file_path):
+    """Reads a json file with precomputed character formulas; the file is parsed once and shared by all characters."""
+    with Path(file_path).open('r') as file:
+        return json.load(file)
+
+
+character_cache_dir = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'lie_stationary_kernels'
+# a part of the cache file names, to be incremented whenever `_compute_character_formula` or the stored format changes
+character_cache_version = 1
+
+
+def disk_cached_character_formula(fn):
+    """Decorator that stores the result of `_compute_character_formula` on disk.
+
+    The character formula depends only on the group and the signature, so the symbolic computation
+    is done once per (group, signature) and later calls read the cached coefficients and monomials.
+    The undecorated computation, bypassing the cache, is available as `_compute_character_formula.__wrapped__`.
+    """
+    @functools.wraps(fn)
+    def _cached(self):
+        manifold = self.representation.manifold
+        signature = '_'.join(map(str, self.representation.index))
+        path = character_cache_dir / '{}{}_{}.v{}.json'.format(manifold.__class__.__name__.lower(), manifold.n,
+                                                               signature, character_cache_version)
+        if path.exists():
+            with path.open('r') as file:
+                coeffs, monoms = json.load(file)
+            return coeffs, monoms
+        coeffs, monoms = fn(self)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that an interrupted run does not leave a broken cache entry
+        tmp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        with tmp_path.open('w') as file:
+            json.dump((coeffs, monoms), file)
+        os.replace(tmp_path, path)
+        return coeffs, monoms
+    return _cached
+
+
 # class GOE(TorchDistribution):
 #     """Samples from distribution with pdf e^{-t*\lambda^2}\prod_{i<j} |\lambda_i-\lambda_j|"""
 #     arg_constraints = {'scale': constraints.positive}
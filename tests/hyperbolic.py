@@ -62,6 +62,12 @@ class TestHyperbolic(unittest.TestCase):
         dist2 = self.space.pairwise_dist(self.x, self.space.id.view(-1, self.n)).squeeze()
         self.assertTrue(torch.allclose(dist1, dist2))
 
+    def test_dist_diagonal(self):
+        x_boundary = self.space.rand_phase(self.x_size) * (1 - 1e-6)
+        for x in (self.x, x_boundary):
+            dist = self.space.pairwise_dist(x, x)
+            self.assertTrue(torch.all(torch.diagonal(dist) == 0))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -3,7 +3,6 @@ import itertools
 import unittest
 from parameterized import parameterized_class
 import torch
-from torch.autograd.functional import _vmap as vmap
 import numpy as np
 
 from lie_stationary_kernels.spectral_kernel import EigenbasisSumKernel
@@ -11,6 +10,7 @@ from lie_stationary_kernels.spectral_measure import SqExpSpectralMeasure
 from lie_stationary_kernels.prior_approximation import RandomPhaseApproximation
 
 from lie_stationary_kernels.space import TranslatedCharactersBasis
+from lie_stationary_kernels.utils import cartesian_prod
 
 from lie_stationary_kernels.spaces import SO, SU
 
@@ -69,6 +69,14 @@ class TestCompactLieGroups(unittest.TestCase):
             self.assertEqual(round(chi_val.real), irrep.dimension)
             self.assertEqual(round(chi_val.imag), 0)
 
+    def test_character_formula(self):
+        # the symbolic computation reproduces the precomputed parameters, bypassing the disk cache
+        for irrep in self.group.lb_eigenspaces[:3]:
+            chi = irrep.phase_function
+            coeffs, monoms = chi._compute_character_formula.__wrapped__(chi)
+            self.assertEqual(coeffs, chi.coeffs.real.round().int().tolist())
+            self.assertEqual(monoms, chi.monoms.tolist())
+
     def test_characters_orthogonality(self):
         num_samples_x = 10**5
         xs = self.group.rand(num_samples_x)
@@ -107,7 +115,15 @@ class TestCompactLieGroups(unittest.TestCase):
 
     def test_sampler(self):
         true_ans = torch.eye(self.dim, dtype=self.dtype, device=device).reshape((1, self.dim, self.dim)).repeat(self.n, 1, 1)
-        self.assertTrue(torch.allclose(vmap(self.group.difference)(self.x, self.x), true_ans))
+        self.assertTrue(torch.allclose(torch.bmm(self.x, self.group.inv(self.x)), true_ans))
+
+    def test_pairwise_diff(self):
+        x_, y_ = cartesian_prod(self.x, self.y)  # [n,m,d,d] and [n,m,d,d]
+        x_flatten, y_flatten = x_.reshape(-1, self.dim, self.dim), y_.reshape(-1, self.dim, self.dim)
+        x_yinv = torch.bmm(x_flatten, self.group.inv(y_flatten))  # element i*m+j is x_i y_j^{-1}
+        xinv_y = torch.bmm(self.group.inv(x_flatten), y_flatten)  # element i*m+j is x_i^{-1} y_j
+        self.assertTrue(torch.allclose(self.group.pairwise_diff(self.x, self.y), x_yinv))
+        self.assertTrue(torch.allclose(self.group.pairwise_diff(self.x, self.y, reverse=True), xinv_y))
 
     def _test_prior(self) -> None:
         cov_func = self.func_kernel(self.x, self.y)
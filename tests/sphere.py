@@ -1,6 +1,5 @@
 import unittest
 import torch
-from torch.autograd.functional import _vmap as vmap
 
 import numpy as np
 from lie_stationary_kernels.spaces.sphere import Sphere
@@ -46,7 +45,7 @@ class TestSphere(unittest.TestCase):
 
     def test_sampler(self):
         true_ans = torch.ones(self.x_size, dtype=dtype, device=device)
-        self.assertTrue(torch.allclose(vmap(torch.dot)(self.x, self.x), true_ans))
+        self.assertTrue(torch.allclose(torch.sum(self.x * self.x, dim=-1), true_ans))
 
     def test_harmonics(self):
         n = 100000